@@ -1,16 +1,740 @@
-import os, traceback
-from flask import Flask, jsonify, redirect, abort, request
-from auth import requires_auth, AuthError
-from models import setup_db, Actors, Movies, db
+import os, re, json, base64, datetime, operator, traceback
+from sqlalchemy import tuple_, any_, bindparam, exists
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from flask import Flask, Response, jsonify, redirect, abort, request, stream_with_context, g
+from auth import requires_auth, check_permissions, AuthError
+from cache import response_cache
+from instrumentation import init_instrumentation
+from metrics import init_metrics, render_metrics, record_auth_error, METRICS_TOKEN
+from search import search, SEARCHABLE, SEARCH_MAX_OFFSET
+from group_commit import GroupCommitter, GROUP_COMMIT_ENABLED
+from models import setup_db, supports_returning, bump_table_version, get_table_version, \
+    set_request_class, read_from_primary, record_tombstones, parse_release_date, format_date, \
+    movie_cast, Actors, Movies, Tombstones, db
 from flask_cors import CORS
 
 LOGIN_LINK = os.environ['LOGIN_LINK']
+# Largest page a client can ask for
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 100))
+# Page size used when no ?limit= is given, also capped at MAX_PAGE_SIZE
+DEFAULT_PAGE_SIZE = int(os.environ.get('DEFAULT_PAGE_SIZE', MAX_PAGE_SIZE))
+# Rows fetched per round trip by the server side cursor when streaming
+STREAM_BATCH_SIZE = int(os.environ.get('STREAM_BATCH_SIZE', 1000))
+NDJSON_MIMETYPE = 'application/x-ndjson'
+# Results per page of GET /search when no ?limit= is given
+SEARCH_PAGE_SIZE = int(os.environ.get('SEARCH_PAGE_SIZE', 20))
+# Most ids a single GET /actors?ids= or /movies?ids= can ask for
+MAX_LOOKUP_IDS = int(os.environ.get('MAX_LOOKUP_IDS', 100))
+# Most records a single bulk create request can hold
+BULK_MAX_ITEMS = int(os.environ.get('BULK_MAX_ITEMS', 1000))
+# Rows per multi-row INSERT, keeps each statement well under the bind parameter limit
+BULK_INSERT_CHUNK = 500
+ACTOR_FIELDS = ('name', 'age', 'gender')
+MOVIE_FIELDS = ('title', 'release_date')
+ACTOR_SORTS = ('id', 'name', 'age')
+MOVIE_SORTS = ('id', 'title', 'release_date')
+ACTOR_FILTERS = ('gender', 'age_min', 'age_max', 'name')
+MOVIE_FILTERS = ('title', 'released_after', 'released_before')
+# Listing parameters ?ids= has no use for, next to the filters
+PAGE_ARGS = ('sort', 'limit', 'cursor', 'stream')
+# What POST /batch can do to each type, and the model, fields and table behind it
+BATCH_ACTIONS = ('create', 'edit', 'delete')
+BATCH_TYPES = {
+    'actor': (Actors, ACTOR_FIELDS, 'actors'),
+    'movie': (Movies, MOVIE_FIELDS, 'movies')
+}
+BATCH_MESSAGES = {404: "resource not found", 412: "precondition failed", 422: "unprocessable entity"}
+
+# ?include= options of each listing, and the table each one reads from
+INCLUDES = {
+    'actors': {'movies': 'movies'},
+    'movies': {'cast': 'actors'}
+}
+
+# Opaque url safe tokens holding a small json object
+def encode_token(data):
+    raw = json.dumps(data, default=format_date).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_token(token):
+    padded = token + '=' * (-len(token) % 4)
+    data = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    if not isinstance(data, dict):
+        raise ValueError('token must hold an object')
+    return data
+
+# Cursors are opaque to clients, they hold the id (and sort key) of the
+# last row of the previous page
+def encode_cursor(row, sort):
+    name, descending = sort
+    cursor = {'id': row.id}
+    if name != 'id':
+        cursor['s'] = name
+        cursor['k'] = getattr(row, name)
+    return encode_token(cursor)
+
+def decode_cursor(cursor, model, sort):
+    cursor = decode_token(cursor)
+    if type(cursor.get('id')) is not int:
+        raise ValueError('cursor id must be an integer')
+    if sort[0] != 'id':
+        if cursor.get('s') != sort[0] or 'k' not in cursor:
+            raise ValueError('cursor was made for another sort')
+        if cursor['k'] is not None:
+            cursor['k'] = cursor_key(getattr(model, sort[0]), cursor['k'])
+    return cursor
+
+# Checks a cursor's sort key against the column's type, dates come back as strings
+def cursor_key(column, key):
+    python_type = column.type.python_type
+    if python_type is datetime.date:
+        return parse_release_date(key)
+    if type(key) is not python_type:
+        raise ValueError('cursor key must be a {}'.format(python_type.__name__))
+    return key
+
+# Sync tokens hold the (change_seq, id) of the last change a client got
+def encode_since(change_seq, record_id):
+    return encode_token({'s': change_seq, 'id': record_id})
+
+def decode_since(token):
+    since = decode_token(token)
+    if type(since.get('id')) is not int or type(since.get('s')) is not int:
+        raise ValueError('since token must hold a change sequence number and an id')
+    return since['s'], since['id']
+
+# Reads ?since= and ?limit= of the /changes endpoints, aborts with a 400 if either is malformed
+def get_changes_args():
+    since = request.args.get('since', None)
+    limit = request.args.get('limit', MAX_PAGE_SIZE)
+    try:
+        since = decode_since(since) if since else None
+        limit = int(limit)
+        if limit < 1:
+            raise ValueError('limit must be positive')
+    except Exception:
+        abort(400)
+    return since, min(limit, MAX_PAGE_SIZE)
+
+# Reads ?sort=, a sortable column name with a leading - for descending
+def get_sort(sortable):
+    sort = request.args.get('sort', 'id')
+    name = sort[1:] if sort.startswith('-') else sort
+    if name not in sortable:
+        abort(400)
+    return name, sort.startswith('-')
+
+# Reads ?limit= and ?cursor=, aborts with a 400 if either is malformed
+def get_page_args(model, sort=('id', False)):
+    limit = request.args.get('limit', None)
+    cursor = request.args.get('cursor', None)
+    try:
+        cursor = decode_cursor(cursor, model, sort) if cursor else None
+        if limit is not None:
+            limit = int(limit)
+            if limit < 1:
+                raise ValueError('limit must be positive')
+    except Exception:
+        abort(400)
+    if limit is None:
+        limit = DEFAULT_PAGE_SIZE or MAX_PAGE_SIZE
+    return min(limit, MAX_PAGE_SIZE), cursor
+
+# Orders by the sort column then id, and starts after the cursor's row.
+# Returns the queries of the page's parts in order: the rows with a sort
+# key, a (column, id) row value range scan of the (column, id) index, then
+# the rows without one by id
+def keyset(query, model, sort, cursor):
+    name, descending = sort
+    after = operator.lt if descending else operator.gt
+    order = operator.methodcaller('desc') if descending else (lambda column: column)
+    if name == 'id':
+        if cursor is not None:
+            query = query.filter(after(model.id, cursor['id']))
+        return [query.order_by(order(model.id))]
+
+    column = getattr(model, name)
+    nulls = query.filter(column.is_(None))
+    if cursor is not None and cursor['k'] is None:
+        return [nulls.filter(after(model.id, cursor['id'])).order_by(order(model.id))]
+    keyed = query.filter(column.isnot(None))
+    if cursor is not None:
+        keyed = query.filter(after(tuple_(column, model.id), (cursor['k'], cursor['id'])))
+    return [keyed.order_by(order(column), order(model.id)), nulls.order_by(order(model.id))]
+
+# Streams read the whole table unless a ?limit= was given, which
+# get_page_args has already validated and capped at MAX_PAGE_SIZE
+def stream_limit(limit):
+    return limit if 'limit' in request.args else None
+
+# Keyset pagination, every page is an index range scan and never an OFFSET
+def paginate(query, model, limit, cursor, sort=('id', False)):
+    parts = keyset(query, model, sort, cursor)
+    rows = []
+    for part in parts:
+        if len(rows) > limit:
+            break
+        rows.extend(part.limit(limit + 1 - len(rows)).all())
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1], sort)
+    return rows, next_cursor
+
+# Rows of a query ordered by (change_seq, id) after the since watermark,
+# a row value comparison that is a range scan of the (change_seq, id) index
+def after_watermark(query, change_seq, record_id, since):
+    query = query.filter(change_seq.isnot(None))
+    if since is not None:
+        query = query.filter(tuple_(change_seq, record_id) > since)
+    return query.order_by(change_seq, record_id)
+
+# The rows inserted or edited and the ids deleted since the watermark, in
+# the order they were committed. Returns one (id, record) per change with
+# None as the record of a deletion, the token to sync from next time and
+# whether more changes are waiting. A tombstone of an id that was used
+# again is left out, the row that came back is sent instead. Without a
+# watermark every row is a change and tombstones are skipped, the client
+# never had those rows
+def changes_since(model, since=None, limit=MAX_PAGE_SIZE):
+    records = after_watermark(model.query, model.change_seq, model.id, since).limit(limit + 1).all()
+    changes = [(record.change_seq, record.id, record) for record in records]
+    if since is not None:
+        table = model.__table__
+        tombstones = after_watermark(
+            db.session.query(Tombstones.change_seq, Tombstones.record_id).filter(
+                Tombstones.table_name == model.__tablename__,
+                ~exists().where(table.c.id == Tombstones.record_id)),
+            Tombstones.change_seq, Tombstones.record_id, since).limit(limit + 1).all()
+        changes.extend((tombstone.change_seq, tombstone.record_id, None) for tombstone in tombstones)
+    changes.sort(key=lambda change: (change[0], change[1]))
+
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+    next_since = encode_since(*since) if since is not None else None
+    if changes:
+        next_since = encode_since(changes[-1][0], changes[-1][1])
+    # An id deleted twice in the page only needs its last tombstone
+    last = {record_id: index for index, (change_seq, record_id, record) in enumerate(changes)}
+    return [(record_id, record) for index, (change_seq, record_id, record) in enumerate(changes)
+        if last[record_id] == index], next_since, has_more
+
+# One entry of a /changes response, the record or that its id was deleted
+def format_change(kind, record_id, record):
+    if record is None:
+        return {"id": record_id, "deleted": True}
+    return {"id": record_id, "deleted": False, kind: record.format()}
+
+# Escapes % and _ so a prefix can be used in LIKE
+def like_prefix(prefix):
+    return prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+# Filters for GET /actors, each one is served by an index on the actors table
+def get_actor_filters():
+    filters = []
+    try:
+        if 'gender' in request.args:
+            filters.append(Actors.gender == request.args['gender'])
+        if 'age_min' in request.args:
+            filters.append(Actors.age >= int(request.args['age_min']))
+        if 'age_max' in request.args:
+            filters.append(Actors.age <= int(request.args['age_max']))
+    except ValueError:
+        abort(400)
+    if request.args.get('name'):
+        filters.append(Actors.name.like(like_prefix(request.args['name']), escape='\\'))
+    return filters
+
+# Filters for GET /movies, each one is served by an index on the movies table
+def get_movie_filters():
+    filters = []
+    if request.args.get('title'):
+        filters.append(Movies.title.like(like_prefix(request.args['title']), escape='\\'))
+    try:
+        if 'released_after' in request.args:
+            filters.append(Movies.release_date >= parse_release_date(request.args['released_after']))
+        if 'released_before' in request.args:
+            filters.append(Movies.release_date <= parse_release_date(request.args['released_before']))
+    except ValueError:
+        abort(400)
+    return filters
+
+# Strong ETag for everything served from a table, taken from its change counter.
+# Read at most once per request
+def table_etag(name):
+    etags = g.setdefault('table_etags', {})
+    if name not in etags:
+        etags[name] = '{}-{}'.format(name, get_table_version(name))
+    return etags[name]
+
+# Records a write to a table: bumps its change counter and drops its cached responses
+def table_changed(name):
+    bump_table_version(name)
+    response_cache.invalidate(name)
+
+# Answers If-None-Match with a 304 without reading any rows
+def not_modified(etag):
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    return None
+
+# The ETag of one row, scoped by table and id so the tags of two rows never
+# match. Sent back as If-Match it gives the version an edit expects
+def row_etag(name, record_id, version):
+    return '{}/{}-v{}'.format(name, record_id, version)
+
+ROW_ETAG = re.compile(r'^(\w+)/(\d+)-v(\d+)$')
+
+# Answers If-None-Match for one row after reading only its version
+def row_not_modified(model, record_id):
+    if not request.if_none_match:
+        return None
+    version = db.session.query(model.version).filter_by(id=record_id).scalar()
+    if version is None:
+        return None
+    return not_modified(row_etag(model.__tablename__, record_id, version))
+
+# Sends the json with the table's ETag
+def tagged_json(etag, data):
+    response = jsonify(data)
+    response.set_etag(etag)
+    return response
+
+# Reads ?fields=, a comma separated list of the model's columns.
+# id and the sort column are always included, the cursor needs them
+def get_fields(model, sort=('id', False)):
+    fields = request.args.get('fields', None)
+    if fields is None:
+        return None
+    names = [name.strip() for name in fields.split(',') if name.strip()]
+    columns = model.__table__.columns.keys()
+    if not names or any(name not in columns for name in names):
+        abort(400)
+    return list(dict.fromkeys(['id', sort[0]] + names))
+
+# Query and formatter for a listing. With ?fields= only those columns are
+# selected, as plain rows that skip the ORM identity map
+def listing_query(model, fields):
+    if fields is None:
+        return model.query, model.format
+    columns = [getattr(model, name) for name in fields]
+    return db.session.query(*columns), row_to_dict
+
+def row_to_dict(row):
+    return {column: format_date(value) for column, value in row._mapping.items()}
+
+# Reads ?include=, the related rows to add to each item of a listing
+def get_includes(name):
+    include = request.args.get('include', None)
+    if include is None:
+        return []
+    names = [part.strip() for part in include.split(',') if part.strip()]
+    if not names or any(part not in INCLUDES[name] for part in names):
+        abort(400)
+    return list(dict.fromkeys(names))
+
+# One query for the actors of every movie on a page
+def load_cast(movie_ids):
+    rows = db.session.query(movie_cast.c.movie_id, Actors).join(
+        Actors, Actors.id == movie_cast.c.actor_id).filter(
+        movie_cast.c.movie_id.in_(movie_ids)).order_by(Actors.id)
+    cast = {}
+    for movie_id, actor in rows:
+        cast.setdefault(movie_id, []).append(actor.format())
+    return cast
+
+# One query for the movies of every actor on a page
+def load_filmography(actor_ids):
+    rows = db.session.query(movie_cast.c.actor_id, Movies).join(
+        Movies, Movies.id == movie_cast.c.movie_id).filter(
+        movie_cast.c.actor_id.in_(actor_ids)).order_by(Movies.id)
+    filmography = {}
+    for actor_id, movie in rows:
+        filmography.setdefault(actor_id, []).append(movie.format())
+    return filmography
+
+RELATED_LOADERS = {
+    'cast': load_cast,
+    'movies': load_filmography
+}
+
+# Adds the included related rows to formatted items, one query per include
+# no matter how many items there are
+def attach_includes(items, includes):
+    if not items:
+        return items
+    ids = [item['id'] for item in items]
+    for include in includes:
+        related = RELATED_LOADERS[include](ids)
+        for item in items:
+            item[include] = related.get(item['id'], [])
+    return items
+
+# Reads ?ids=1,2,3, None when it isn't given. Aborts with a 400 when an id
+# isn't an integer or it comes with a filter or page parameter, which it
+# would not apply, and a 413 when there are more than MAX_LOOKUP_IDS
+def get_lookup_ids(filters):
+    if 'ids' not in request.args:
+        return None
+    if any(name in request.args for name in PAGE_ARGS + filters):
+        abort(400)
+    values = [value.strip() for value in request.args.get('ids').split(',') if value.strip()]
+    if not values or not all(value.isdigit() for value in values):
+        abort(400)
+    if len(values) > MAX_LOOKUP_IDS:
+        abort(413)
+    return list(dict.fromkeys(int(value) for value in values))
+
+# WHERE id = ANY(:ids) on postgres, one array parameter whatever the
+# number of ids, and an IN list elsewhere
+def id_in(model, ids):
+    if db.engine.dialect.name == 'postgresql':
+        return model.id == any_(bindparam('lookup_ids', ids, type_=ARRAY(db.Integer)))
+    return model.id.in_(ids)
+
+# Loads the rows of every id with one query. Returns the formatted items in
+# the order asked for, None in place of each missing id, and the missing ids
+def lookup_ids(query, model, formatter, ids, includes):
+    found = {}
+    for row in query.filter(id_in(model, ids)):
+        item = formatter(row)
+        found[item['id']] = item
+    attach_includes(list(found.values()), includes)
+    return [found.get(record_id, None) for record_id in ids], \
+        [record_id for record_id in ids if record_id not in found]
+
+# ETag of a listing, also changes with the tables of anything included
+def listing_etag(name):
+    names = [name]
+    for include in request.args.get('include', '').split(','):
+        table = INCLUDES[name].get(include.strip(), None)
+        if table and table not in names:
+            names.append(table)
+    return ';'.join(table_etag(table) for table in names)
+
+# Streaming is asked for with ?stream=1 or an Accept: application/x-ndjson header
+def wants_stream():
+    if request.args.get('stream', '').lower() in ('1', 'true'):
+        return True
+    best = request.accept_mimetypes.best_match(['application/json', NDJSON_MIMETYPE])
+    return best == NDJSON_MIMETYPE
+
+# Writes one JSON object per line as the rows come off a server side cursor,
+# so memory stays flat and the first row is sent before the last is read
+def stream_ndjson(query, model, formatter, limit=None, cursor=None, sort=('id', False), includes=()):
+    # Exports can run long, they get the bulk statement timeout
+    set_request_class('bulk')
+    parts = keyset(query, model, sort, cursor)
+
+    def rows():
+        remaining = limit
+        for part in parts:
+            if remaining is not None:
+                if remaining <= 0:
+                    return
+                part = part.limit(remaining)
+            for row in part.yield_per(STREAM_BATCH_SIZE):
+                if remaining is not None:
+                    remaining -= 1
+                yield row
+
+    def generate():
+        if not includes:
+            for row in rows():
+                yield json.dumps(formatter(row)) + '\n'
+            return
+        # Related rows are loaded once per batch rather than once per row
+        batch = []
+        for row in rows():
+            batch.append(formatter(row))
+            if len(batch) == STREAM_BATCH_SIZE:
+                yield ''.join(json.dumps(item) + '\n' for item in attach_includes(batch, includes))
+                batch = []
+        if batch:
+            yield ''.join(json.dumps(item) + '\n' for item in attach_includes(batch, includes))
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
+
+# Reads the records of a bulk request, either a json array or {"<key>": [...]}
+def get_bulk_items(key):
+    body = request.get_json(silent=True)
+    items = body.get(key, None) if isinstance(body, dict) else body
+    if not isinstance(items, list) or not items:
+        abort(400)
+    if len(items) > BULK_MAX_ITEMS:
+        abort(413)
+    return items
+
+# Validates every item up front with errors_of(item), which returns a list
+# of errors. Returns a 422 response with each item's errors if any are invalid
+def validation_failure(items, errors_of):
+    results = []
+    for index, item in enumerate(items):
+        errors = errors_of(item)
+        results.append({"index": index, "valid": not errors, "errors": errors})
+    if all(result["valid"] for result in results):
+        return None
+    return jsonify({
+        "success": False,
+        "error": 422,
+        "message": "unprocessable entity",
+        "results": results
+    }), 422
+
+# Inserts the records with one multi-row INSERT ... RETURNING per chunk,
+# inside the caller's transaction
+def bulk_insert(model, fields, items):
+    rows = [{field: item.get(field, None) for field in fields} for item in items]
+    if not supports_returning():
+        created = [model(**row) for row in rows]
+        db.session.add_all(created)
+        db.session.flush()
+        return created
+
+    table = model.__table__
+    created = []
+    for start in range(0, len(rows), BULK_INSERT_CHUNK):
+        chunk = rows[start:start + BULK_INSERT_CHUNK]
+        result = db.session.execute(table.insert().values(chunk).returning(*table.c))
+        created.extend(record_from_row(model, returned) for returned in result)
+    return created
+
+# Single creates share transactions through these when GROUP_COMMIT_ENABLED is on
+actor_committer = GroupCommitter(
+    lambda rows: [actor.format() for actor in bulk_insert(Actors, ACTOR_FIELDS, rows)],
+    lambda: table_changed("actors"))
+movie_committer = GroupCommitter(
+    lambda rows: [movie.format() for movie in bulk_insert(Movies, MOVIE_FIELDS, rows)],
+    lambda: table_changed("movies"))
+
+# Reads the {"movie_id", "actor_id"} pairs of a casting request
+def get_cast_pairs():
+    pairs = []
+    for pair in get_bulk_items("cast"):
+        movie_id = pair.get('movie_id', None) if isinstance(pair, dict) else None
+        actor_id = pair.get('actor_id', None) if isinstance(pair, dict) else None
+        if type(movie_id) is not int or type(actor_id) is not int:
+            abort(422)
+        pairs.append((movie_id, actor_id))
+    return list(dict.fromkeys(pairs))
+
+# Checks the movie and actor of every pair exist, one query per table.
+# Returns a 422 response listing the pairs naming a missing one
+def cast_pairs_failure(pairs):
+    movie_ids = list({movie_id for movie_id, actor_id in pairs})
+    actor_ids = list({actor_id for movie_id, actor_id in pairs})
+    movies = {row.id for row in db.session.query(Movies.id).filter(id_in(Movies, movie_ids))}
+    actors = {row.id for row in db.session.query(Actors.id).filter(id_in(Actors, actor_ids))}
+    results = []
+    for movie_id, actor_id in pairs:
+        errors = []
+        if movie_id not in movies:
+            errors.append('movie {} does not exist'.format(movie_id))
+        if actor_id not in actors:
+            errors.append('actor {} does not exist'.format(actor_id))
+        if errors:
+            results.append({"movie_id": movie_id, "actor_id": actor_id, "errors": errors})
+    if not results:
+        return None
+    return jsonify({
+        "success": False,
+        "error": 422,
+        "message": "unprocessable entity",
+        "results": results
+    }), 422
+
+# Multi-row INSERT of cast pairs, pairs that already exist are skipped.
+# Returns how many were added
+def insert_cast(pairs):
+    added = 0
+    for start in range(0, len(pairs), BULK_INSERT_CHUNK):
+        rows = [{'movie_id': movie_id, 'actor_id': actor_id}
+            for movie_id, actor_id in pairs[start:start + BULK_INSERT_CHUNK]]
+        if db.engine.dialect.name == 'postgresql':
+            statement = postgresql_insert(movie_cast).values(rows).on_conflict_do_nothing()
+        else:
+            statement = movie_cast.insert().prefix_with('OR IGNORE', dialect='sqlite').values(rows)
+        added += db.session.execute(statement).rowcount
+    return added
+
+# Builds a detached model object from a row sent back by RETURNING or a core select
+def record_from_row(model, row):
+    record = model.__mapper__.class_manager.new_instance()
+    for column, value in row._mapping.items():
+        setattr(record, column, value)
+    return record
+
+# Reads the fields an edit should change, only the ones sent are updated
+def get_edit_changes(model, fields):
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or body.get('id', None) is None:
+        abort(400)
+    changes = {field: body[field] for field in fields if field in body}
+    if not changes:
+        abort(400)
+    if model.validate(changes, partial=True):
+        abort(422)
+    return body['id'], changes
+
+# The version an edit expects, from an If-Match header or a "version" in the body.
+# If-Match takes the row's ETag, or its bare version
+def get_expected_version(name, record_id):
+    if request.if_match:
+        if request.if_match.star_tag:
+            return None
+        tags = request.if_match.as_set()
+        if len(tags) != 1:
+            abort(412)
+        tag = tags.pop()
+        if tag.isdigit():
+            return int(tag)
+        match = ROW_ETAG.match(tag)
+        if match is None or match.group(1) != name or match.group(2) != str(record_id):
+            abort(412)
+        return int(match.group(3))
+    version = (request.get_json(silent=True) or {}).get('version', None)
+    if version is not None and not isinstance(version, int):
+        abort(400)
+    return version
+
+# One UPDATE ... WHERE id = :id AND version = :v RETURNING * for an edit.
+# Returns the edited record, or None and the status to abort with
+def update_versioned(model, record_id, changes, expected_version):
+    table = model.__table__
+    statement = table.update().where(table.c.id == record_id)
+    if expected_version is not None:
+        statement = statement.where(table.c.version == expected_version)
+    statement = statement.values(version=table.c.version + 1, **changes)
+
+    if supports_returning():
+        row = db.session.execute(statement.returning(*table.c)).first()
+    else:
+        result = db.session.execute(statement)
+        row = None
+        if result.rowcount:
+            row = db.session.execute(table.select().where(table.c.id == record_id)).first()
+    if row is not None:
+        return record_from_row(model, row), None
+
+    # Only a failed edit pays for telling a missing row from a stale version
+    exists = db.session.execute(table.select().with_only_columns([table.c.id]).where(
+        table.c.id == record_id)).first()
+    return None, 412 if exists else 404
+
+# Reads the ids to delete: "id" or an "ids" list in the json body, or
+# ?id= or ?ids=1,2,3. Aborts with a 422 when there are none or one isn't
+# an integer, and a 413 when there are more than BULK_MAX_ITEMS
+def get_delete_ids():
+    body = request.get_json(silent=True)
+    values = []
+    if isinstance(body, dict):
+        values = body.get('ids', None) if 'ids' in body else [body.get('id', None)]
+    elif 'ids' in request.args:
+        values = request.args.get('ids').split(',')
+    elif 'id' in request.args:
+        values = request.args.getlist('id')
+    if not isinstance(values, list) or not values:
+        abort(422)
+    if len(values) > BULK_MAX_ITEMS:
+        abort(413)
+    ids = []
+    for value in values:
+        if isinstance(value, str) and value.strip().isdigit():
+            value = int(value)
+        if type(value) is not int:
+            abort(422)
+        ids.append(value)
+    return list(dict.fromkeys(ids))
+
+# One DELETE ... WHERE id IN (...) RETURNING id inside the caller's transaction,
+# leaving a tombstone per deleted row. Returns the deleted and the missing ids, both in the order asked for
+def delete_by_ids(model, ids):
+    table = model.__table__
+    statement = table.delete().where(table.c.id.in_(ids))
+    if supports_returning():
+        deleted = {row.id for row in db.session.execute(statement.returning(table.c.id))}
+    else:
+        deleted = {row.id for row in db.session.execute(
+            table.select().with_only_columns([table.c.id]).where(table.c.id.in_(ids)))}
+        db.session.execute(statement)
+    record_tombstones(model.__tablename__, [record_id for record_id in ids if record_id in deleted])
+    return [record_id for record_id in ids if record_id in deleted], \
+        [record_id for record_id in ids if record_id not in deleted]
+
+# Response of the delete endpoints, a 404 when nothing matched
+def deleted_response(kind, deleted, missing):
+    if not deleted:
+        abort(404)
+    response = {
+        "success": True,
+        "deleted": deleted,
+        "missing": missing
+    }
+    if len(deleted) == 1:
+        response["deleted_{}_id".format(kind)] = deleted[0]
+    return jsonify(response)
+
+# The errors of one POST /batch operation, an empty list when it is valid
+def batch_operation_errors(operation):
+    if not isinstance(operation, dict):
+        return ['operation must be an object']
+    if operation.get('action', None) not in BATCH_ACTIONS:
+        return ['action must be one of ' + ', '.join(BATCH_ACTIONS)]
+    if operation.get('type', None) not in BATCH_TYPES:
+        return ['type must be one of ' + ', '.join(BATCH_TYPES)]
+    model, fields, name = BATCH_TYPES[operation['type']]
+    action = operation['action']
+    if action == 'create':
+        return model.validate(operation)
+    if action == 'edit':
+        errors = []
+        if type(operation.get('id', None)) is not int:
+            errors.append('id must be an integer')
+        if not any(field in operation for field in fields):
+            errors.append('nothing to change, send one of ' + ', '.join(fields))
+        if operation.get('version', None) is not None and type(operation['version']) is not int:
+            errors.append('version must be an integer')
+        return errors + model.validate({field: operation[field] for field in fields if field in operation}, partial=True)
+    ids = operation.get('ids', None) if 'ids' in operation else [operation.get('id', None)]
+    if not isinstance(ids, list) or not ids or any(type(record_id) is not int for record_id in ids):
+        return ['id must be an integer, or ids a list of integers']
+    if len(ids) > BULK_MAX_ITEMS:
+        return ['at most {} ids can be deleted at once'.format(BULK_MAX_ITEMS)]
+    return []
+
+def batch_permission(operation):
+    return '{}:{}'.format(operation['action'], BATCH_TYPES[operation['type']][2])
+
+# Runs one valid operation inside the caller's transaction. Returns its
+# result, or None and the status it failed with
+def run_batch_operation(operation):
+    kind = operation['type']
+    model, fields, name = BATCH_TYPES[kind]
+    if operation['action'] == 'create':
+        record = bulk_insert(model, fields, [operation])[0]
+        return {kind: record.format()}, None
+    if operation['action'] == 'edit':
+        changes = {field: operation[field] for field in fields if field in operation}
+        record, error = update_versioned(model, operation['id'], changes, operation.get('version', None))
+        if error:
+            return None, error
+        return {kind: record.format()}, None
+    ids = operation['ids'] if 'ids' in operation else [operation['id']]
+    deleted, missing = delete_by_ids(model, list(dict.fromkeys(ids)))
+    if not deleted:
+        return None, 404
+    return {"deleted": deleted, "missing": missing}, None
 
 def create_app(test_config=None):
 
     app = Flask(__name__)
     setup_db(app)
     CORS(app)
+    init_instrumentation(app)
+    init_metrics(app)
 
     # Route that works for anyone with the link
     @app.route('/', methods=['GET'])
@@ -44,20 +768,39 @@ def create_app(test_config=None):
     # Endpoint for viewing actors.
     @app.route('/actors', methods=['GET'])
     @requires_auth('read:actors')
+    @response_cache.cached("actors", listing_etag)
     def actor_view(payload):
+        sort = get_sort(ACTOR_SORTS)
+        limit, cursor = get_page_args(Actors, sort)
+        fields = get_fields(Actors, sort)
+        filters = get_actor_filters()
+        includes = get_includes("actors")
+        ids = get_lookup_ids(ACTOR_FILTERS)
         try:
-            formatted_actors = []
-            actors = Actors.query.all()
-            for actor in actors:
-                formatted_actors.append({
-                    "id": actor.id,
-                    "name": actor.name,
-                    "age": actor.age,
-                    "gender": actor.gender,
+            query, formatter = listing_query(Actors, fields)
+            if ids is not None:
+                etag = listing_etag("actors")
+                unchanged = not_modified(etag)
+                if unchanged:
+                    return unchanged
+                actors, missing = lookup_ids(query, Actors, formatter, ids, includes)
+                return tagged_json(etag, {
+                    "success": True,
+                    "actors": actors,
+                    "missing": missing
                 })
-            return jsonify({
+            query = query.filter(*filters)
+            if wants_stream():
+                return stream_ndjson(query, Actors, formatter, stream_limit(limit), cursor, sort, includes)
+            etag = listing_etag("actors")
+            unchanged = not_modified(etag)
+            if unchanged:
+                return unchanged
+            actors, next_cursor = paginate(query, Actors, limit, cursor, sort)
+            return tagged_json(etag, {
                 "success": True,
-                "actors": formatted_actors
+                "actors": attach_includes([formatter(actor) for actor in actors], includes),
+                "next_cursor": next_cursor
             })
         except:
             traceback.print_exc()
@@ -66,10 +809,14 @@ def create_app(test_config=None):
     # Endpoint for viewing single actor by id.
     @app.route('/actors/<int:id>', methods=['GET'])
     @requires_auth('read:actors')
+    @response_cache.cached("actors", table_etag)
     def single_actor_view(payload, id):
         try:
+            unchanged = row_not_modified(Actors, id)
+            if unchanged:
+                return unchanged
             actor = Actors.query.filter_by(id=id).one()
-            return jsonify({
+            return tagged_json(row_etag("actors", id, actor.version), {
                 "success": True,
                 "actor": actor.format()
             })
@@ -77,22 +824,116 @@ def create_app(test_config=None):
             traceback.print_exc()
             abort(500)
 
+    # Endpoint for syncing actors, only the actors added, edited or
+    # deleted since the ?since= token of the last sync are sent
+    @app.route('/actors/changes', methods=['GET'])
+    @requires_auth('read:actors')
+    def actor_changes(payload):
+        since, limit = get_changes_args()
+        try:
+            read_from_primary()
+            changes, next_since, has_more = changes_since(Actors, since, limit)
+            return jsonify({
+                "success": True,
+                "changes": [format_change("actor", record_id, actor) for record_id, actor in changes],
+                "next_since": next_since,
+                "has_more": has_more
+            })
+        except:
+            traceback.print_exc()
+            abort(500)
+
     # Endpoint for viewing movies.
     @app.route('/movies', methods=['GET'])
     @requires_auth('read:movies')
+    @response_cache.cached("movies", listing_etag)
     def movie_view(payload):
+        sort = get_sort(MOVIE_SORTS)
+        limit, cursor = get_page_args(Movies, sort)
+        fields = get_fields(Movies, sort)
+        filters = get_movie_filters()
+        includes = get_includes("movies")
+        ids = get_lookup_ids(MOVIE_FILTERS)
         try:
-            formatted_movies = []
-            movies = Movies.query.all()
-            for movie in movies:
-                formatted_movies.append({
-                    "id": movie.id,
-                    "title": movie.title,
-                    "release_date": movie.release_date
+            query, formatter = listing_query(Movies, fields)
+            if ids is not None:
+                etag = listing_etag("movies")
+                unchanged = not_modified(etag)
+                if unchanged:
+                    return unchanged
+                movies, missing = lookup_ids(query, Movies, formatter, ids, includes)
+                return tagged_json(etag, {
+                    "success": True,
+                    "movies": movies,
+                    "missing": missing
                 })
+            query = query.filter(*filters)
+            if wants_stream():
+                return stream_ndjson(query, Movies, formatter, stream_limit(limit), cursor, sort, includes)
+            etag = listing_etag("movies")
+            unchanged = not_modified(etag)
+            if unchanged:
+                return unchanged
+            movies, next_cursor = paginate(query, Movies, limit, cursor, sort)
+            return tagged_json(etag, {
+                "success": True,
+                "movies": attach_includes([formatter(movie) for movie in movies], includes),
+                "next_cursor": next_cursor
+            })
+        except:
+            traceback.print_exc()
+            abort(500)
+
+    # Endpoint for syncing movies, only the movies added, edited or
+    # deleted since the ?since= token of the last sync are sent
+    @app.route('/movies/changes', methods=['GET'])
+    @requires_auth('read:movies')
+    def movie_changes(payload):
+        since, limit = get_changes_args()
+        try:
+            read_from_primary()
+            changes, next_since, has_more = changes_since(Movies, since, limit)
+            return jsonify({
+                "success": True,
+                "changes": [format_change("movie", record_id, movie) for record_id, movie in changes],
+                "next_since": next_since,
+                "has_more": has_more
+            })
+        except:
+            traceback.print_exc()
+            abort(500)
+
+    # Endpoint for searching movie titles and actor names, misspellings
+    # and partial names included. Only searches what the token can read
+    @app.route('/search', methods=['GET'])
+    @requires_auth('')
+    def search_view(payload):
+        kinds = [kind for kind, model, column, permission in SEARCHABLE
+            if permission in payload['permissions']]
+        if not kinds:
+            raise AuthError({
+                'code': 'unauthorized',
+                'description': 'Permission not found.'
+            }, 403)
+        query = request.args.get('q', '').strip()
+        if len(query) < 2 or len(query) > 120:
+            abort(400)
+        try:
+            limit = min(int(request.args.get('limit', SEARCH_PAGE_SIZE)), MAX_PAGE_SIZE)
+            offset = decode_token(request.args['cursor'])['o'] if 'cursor' in request.args else 0
+            if limit < 1 or not isinstance(offset, int) or not 0 <= offset <= SEARCH_MAX_OFFSET:
+                raise ValueError('bad page')
+        except Exception:
+            abort(400)
+        try:
+            results = search(query, kinds, limit + 1, offset)
+            next_cursor = None
+            if len(results) > limit and offset + limit <= SEARCH_MAX_OFFSET:
+                next_cursor = encode_token({'o': offset + limit})
             return jsonify({
                 "success": True,
-                "movies": formatted_movies
+                "results": results[:limit],
+                "next_cursor": next_cursor
             })
         except:
             traceback.print_exc()
@@ -101,10 +942,14 @@ def create_app(test_config=None):
     # Endpoint for viewing single movie by id.
     @app.route('/movies/<int:id>', methods=['GET'])
     @requires_auth('read:movies')
+    @response_cache.cached("movies", table_etag)
     def single_movie_view(payload, id):
         try:
+            unchanged = row_not_modified(Movies, id)
+            if unchanged:
+                return unchanged
             movie = Movies.query.filter_by(id=id).one()
-            return jsonify({
+            return tagged_json(row_etag("movies", id, movie.version), {
                 "success": True,
                 "movie": movie.format()
             })
@@ -116,16 +961,24 @@ def create_app(test_config=None):
     @app.route('/actors', methods=['POST'])
     @requires_auth('create:actors')
     def create_actor(payload):
+        if Actors.validate(request.get_json(silent=True)):
+            abort(422)
         try:
             name = request.get_json().get("name", None)
             age = request.get_json().get("age", None)
             gender = request.get_json().get("gender", None)
+            if GROUP_COMMIT_ENABLED:
+                return jsonify({
+                    "success": True,
+                    "actor": actor_committer.submit({"name": name, "age": age, "gender": gender})
+                })
             new_actor = Actors(
                 name=name,
                 age=age,
                 gender=gender
             )
             db.session.add(new_actor)
+            table_changed("actors")
             db.session.commit()
             return jsonify({
                 "success": True,
@@ -140,14 +993,22 @@ def create_app(test_config=None):
     @app.route('/movies', methods=['POST'])
     @requires_auth('create:movies')
     def create_movie(payload):
+        if Movies.validate(request.get_json(silent=True)):
+            abort(422)
         try:
             title = request.get_json().get("title", None)
             release_date = request.get_json().get("release_date", None)
+            if GROUP_COMMIT_ENABLED:
+                return jsonify({
+                    "success": True,
+                    "movie": movie_committer.submit({"title": title, "release_date": release_date})
+                })
             new_movie = Movies(
                 title=title,
                 release_date=release_date
             )
             db.session.add(new_movie)
+            table_changed("movies")
             db.session.commit()
             return jsonify({
                 "success": True,
@@ -158,125 +1019,272 @@ def create_app(test_config=None):
             traceback.print_exc()
             abort(422)
 
-    # Endpoint for editing actors
-    @app.route('/actors', methods=['PATCH'])
-    @requires_auth('edit:actors')
-    def edit_actor(payload):
+    # Endpoint for creating many actors in one transaction
+    @app.route('/actors/bulk', methods=['POST'])
+    @requires_auth('create:actors')
+    def bulk_create_actors(payload):
+        set_request_class('bulk')
+        actors = get_bulk_items("actors")
+        failure = validation_failure(actors, Actors.validate)
+        if failure:
+            return failure
         try:
-            actor_id = request.get_json().get("id", None)
-            name = request.get_json().get("name", None)
-            age = request.get_json().get("age", None)
-            gender = request.get_json().get("gender", None)
-            edited_actor = Actors.query.get(actor_id)
-            edited_actor.name = name
-            edited_actor.age = age
-            edited_actor.gender = gender
+            created_actors = bulk_insert(Actors, ACTOR_FIELDS, actors)
+            table_changed("actors")
             db.session.commit()
             return jsonify({
                 "success": True,
-                "actor": edited_actor.format()
+                "created": len(created_actors),
+                "results": [{"index": index, "success": True, "actor": actor.format()}
+                    for index, actor in enumerate(created_actors)]
             })
         except:
             db.session.rollback()
             traceback.print_exc()
             abort(422)
 
-    # Endpoint for editing movies
-    @app.route('/movies', methods=['PATCH'])
+    # Endpoint for creating many movies in one transaction
+    @app.route('/movies/bulk', methods=['POST'])
+    @requires_auth('create:movies')
+    def bulk_create_movies(payload):
+        set_request_class('bulk')
+        movies = get_bulk_items("movies")
+        failure = validation_failure(movies, Movies.validate)
+        if failure:
+            return failure
+        try:
+            created_movies = bulk_insert(Movies, MOVIE_FIELDS, movies)
+            table_changed("movies")
+            db.session.commit()
+            return jsonify({
+                "success": True,
+                "created": len(created_movies),
+                "results": [{"index": index, "success": True, "movie": movie.format()}
+                    for index, movie in enumerate(created_movies)]
+            })
+        except:
+            db.session.rollback()
+            traceback.print_exc()
+            abort(422)
+
+    # Endpoint for running creates, edits and deletes of actors and movies
+    # in order, all in one transaction. Every operation needs its own
+    # permission, and if one fails none of them are applied
+    @app.route('/batch', methods=['POST'])
+    @requires_auth('')
+    def batch(payload):
+        operations = get_bulk_items("operations")
+        failure = validation_failure(operations, batch_operation_errors)
+        if failure:
+            return failure
+        for operation in operations:
+            check_permissions(batch_permission(operation), payload)
+        results = []
+        error = None
+        try:
+            for index, operation in enumerate(operations):
+                result, error = run_batch_operation(operation)
+                if error:
+                    break
+                results.append(dict({"index": index, "success": True}, **result))
+            if error:
+                db.session.rollback()
+            else:
+                for name in dict.fromkeys(BATCH_TYPES[operation['type']][2] for operation in operations):
+                    table_changed(name)
+                db.session.commit()
+        except:
+            db.session.rollback()
+            traceback.print_exc()
+            abort(422)
+        finally:
+            db.session.close()
+        if error:
+            return jsonify({
+                "success": False,
+                "error": error,
+                "message": BATCH_MESSAGES[error],
+                "failed_index": len(results),
+                "results": [{"index": result["index"], "success": True, "rolled_back": True} for result in results] +
+                    [{"index": len(results), "success": False, "error": error}]
+            }), error
+        return jsonify({
+            "success": True,
+            "results": results
+        })
+
+    # Endpoint for casting actors in movies, takes many pairs at once
+    @app.route('/cast', methods=['POST'])
     @requires_auth('edit:movies')
-    def edit_movie(payload):
+    def assign_cast(payload):
+        pairs = get_cast_pairs()
+        failure = cast_pairs_failure(pairs)
+        if failure:
+            return failure
         try:
-            movie_id = request.get_json().get("id", None)
-            title = request.get_json().get("title", None)
-            release_date = request.get_json().get("release_date", None)
-            edited_movie = Movies.query.get(movie_id)
-            edited_movie.title = title
-            edited_movie.release_date = release_date
+            assigned = insert_cast(pairs)
+            table_changed("movies")
+            table_changed("actors")
+            db.session.commit()
+            return jsonify({
+                "success": True,
+                "assigned": assigned
+            })
+        except:
+            db.session.rollback()
+            traceback.print_exc()
+            abort(422)
+
+    # Endpoint for taking actors out of movies, takes many pairs at once
+    @app.route('/cast', methods=['DELETE'])
+    @requires_auth('edit:movies')
+    def unassign_cast(payload):
+        pairs = get_cast_pairs()
+        try:
+            result = db.session.execute(movie_cast.delete().where(
+                tuple_(movie_cast.c.movie_id, movie_cast.c.actor_id).in_(pairs)))
+            table_changed("movies")
+            table_changed("actors")
             db.session.commit()
             return jsonify({
                 "success": True,
-                "movie": edited_movie.format()
+                "unassigned": result.rowcount
             })
         except:
             db.session.rollback()
             traceback.print_exc()
             abort(422)
 
+    # Endpoint for editing actors, only the fields sent are changed
+    @app.route('/actors', methods=['PATCH'])
+    @requires_auth('edit:actors')
+    def edit_actor(payload):
+        actor_id, changes = get_edit_changes(Actors, ACTOR_FIELDS)
+        expected_version = get_expected_version("actors", actor_id)
+        try:
+            edited_actor, error = update_versioned(Actors, actor_id, changes, expected_version)
+            if not error:
+                table_changed("actors")
+            db.session.commit()
+        except:
+            db.session.rollback()
+            traceback.print_exc()
+            abort(422)
+        if error:
+            abort(error)
+        response = jsonify({
+            "success": True,
+            "actor": edited_actor.format()
+        })
+        response.set_etag(row_etag("actors", edited_actor.id, edited_actor.version))
+        return response
+
+    # Endpoint for editing movies, only the fields sent are changed
+    @app.route('/movies', methods=['PATCH'])
+    @requires_auth('edit:movies')
+    def edit_movie(payload):
+        movie_id, changes = get_edit_changes(Movies, MOVIE_FIELDS)
+        expected_version = get_expected_version("movies", movie_id)
+        try:
+            edited_movie, error = update_versioned(Movies, movie_id, changes, expected_version)
+            if not error:
+                table_changed("movies")
+            db.session.commit()
+        except:
+            db.session.rollback()
+            traceback.print_exc()
+            abort(422)
+        if error:
+            abort(error)
+        response = jsonify({
+            "success": True,
+            "movie": edited_movie.format()
+        })
+        response.set_etag(row_etag("movies", edited_movie.id, edited_movie.version))
+        return response
+
     # Endpoint for deleting actors
     @app.route('/actors/delete', methods=['DELETE'])
     @requires_auth('delete:actors')
     def delete_actor(payload):
+        actor_ids = get_delete_ids()
         try:
-            actor_id = request.get_json().get("id", None)
-            Actors.query.filter_by(id=actor_id).delete()
+            deleted, missing = delete_by_ids(Actors, actor_ids)
+            if deleted:
+                table_changed("actors")
             db.session.commit()
-            return jsonify({
-                "success": True,
-                "deleted_actor_id": actor_id
-            })
         except:
             traceback.print_exc()
             db.session.rollback()
             abort(422)
         finally:
             db.session.close()
+        return deleted_response("actor", deleted, missing)
 
     # Alternate endpoint for deleting actors
     @app.route('/actors', methods=['DELETE'])
     @requires_auth('delete:actors')
     def axios_delete_actor(payload):
+        actor_ids = get_delete_ids()
         try:
-            actor_id = request.args.get('id')
-            Actors.query.filter_by(id=actor_id).delete()
+            deleted, missing = delete_by_ids(Actors, actor_ids)
+            if deleted:
+                table_changed("actors")
             db.session.commit()
-            return jsonify({
-                "success": True,
-                "deleted_actor_id": actor_id
-            })
         except:
             traceback.print_exc()
             db.session.rollback()
             abort(404)
         finally:
             db.session.close()
+        return deleted_response("actor", deleted, missing)
 
     # Endpoint for deleting movies
     @app.route('/movies/delete', methods=['DELETE'])
     @requires_auth('delete:movies')
     def delete_movie(payload):
+        movie_ids = get_delete_ids()
         try:
-            movie_id = request.get_json().get("id", None)
-            Movies.query.filter_by(id=movie_id).delete()
+            deleted, missing = delete_by_ids(Movies, movie_ids)
+            if deleted:
+                table_changed("movies")
             db.session.commit()
-            return jsonify({
-                "success": True,
-                "deleted_movie_id": movie_id
-            })
         except:
             traceback.print_exc()
             db.session.rollback()
             abort(422)
         finally:
             db.session.close()
+        return deleted_response("movie", deleted, missing)
 
     # Alternate endpoint for deleting movies
     @app.route('/movies', methods=['DELETE'])
     @requires_auth('delete:movies')
     def axios_delete_movie(payload):
+        movie_ids = get_delete_ids()
         try:
-            movie_id = request.args.get('id')
-            Movies.query.filter_by(id=movie_id).delete()
+            deleted, missing = delete_by_ids(Movies, movie_ids)
+            if deleted:
+                table_changed("movies")
             db.session.commit()
-            return jsonify({
-                "success": True,
-                "deleted_movie_id": movie_id
-            })
         except:
             traceback.print_exc()
             db.session.rollback()
             abort(404)
         finally:
             db.session.close()
+        return deleted_response("movie", deleted, missing)
+
+    # Prometheus metrics of every worker, needs the METRICS_TOKEN if one is set
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        if METRICS_TOKEN and request.headers.get('Authorization', '') != 'Bearer ' + METRICS_TOKEN:
+            abort(401)
+        try:
+            return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+        except:
+            traceback.print_exc()
+            abort(500)
 
     # Forcing errors for error tests
 
@@ -305,6 +1313,14 @@ def create_app(test_config=None):
         "message": "bad request"
         }), 400 
 
+    @app.errorhandler(401)
+    def unauthorized(error):
+        return jsonify({
+        "success": False,
+        "error": 401,
+        "message": "unauthorized"
+        }), 401
+
     @app.errorhandler(404)
     def not_found(error):
         return jsonify({
@@ -321,6 +1337,22 @@ def create_app(test_config=None):
         "message": "method not allowed"
         }), 405
 
+    @app.errorhandler(412)
+    def precondition_failed(error):
+        return jsonify({
+        "success": False,
+        "error": 412,
+        "message": "precondition failed"
+        }), 412
+
+    @app.errorhandler(413)
+    def payload_too_large(error):
+        return jsonify({
+        "success": False,
+        "error": 413,
+        "message": "payload too large"
+        }), 413
+
     @app.errorhandler(422)
     def unprocessable_entity(error):
         return jsonify({
@@ -340,6 +1372,7 @@ def create_app(test_config=None):
     # Authorization error handler
     @app.errorhandler(AuthError)
     def auth_error(payload):
+        record_auth_error(payload.error, payload.status_code)
         return jsonify({
             "success": False,
             "error": payload.status_code,
@@ -1,15 +1,33 @@
 import os
+import re
 import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
 from flask import request
 from functools import wraps
-from jose import jwt
+from jose import jwt, jwk
 from urllib.request import urlopen
+from instrumentation import timed_phase
 
 
 AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN']
 ALGORITHMS = os.environ['ALGORITHMS']
 API_AUDIENCE = os.environ['API_AUDIENCE']
 
+# JWKS location, can be pointed at a local file (file:///path/jwks.json) for testing
+JWKS_URL = os.environ.get('JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+# Used when the JWKS response has no Cache-Control max-age
+JWKS_CACHE_TTL = float(os.environ.get('JWKS_CACHE_TTL', 600))
+# Smallest gap between two fetches, caps refetches caused by unknown kids
+JWKS_MIN_REFRESH_INTERVAL = float(os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+JWKS_FETCH_TIMEOUT = float(os.environ.get('JWKS_FETCH_TIMEOUT', 5))
+# Verified token cache, a size of 0 turns it off
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
+# Longest time a verified token is trusted without checking it again
+TOKEN_CACHE_MAX_TTL = float(os.environ.get('TOKEN_CACHE_MAX_TTL', 300))
+
 ## AuthError Exception
 '''
 AuthError Exception
@@ -21,6 +39,232 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+## JWKS Key Store
+def parse_max_age(cache_control):
+    # Returns the max-age of a Cache-Control header in seconds, or None
+    if not cache_control:
+        return None
+    if re.search(r'\bno-(store|cache)\b', cache_control):
+        return 0
+    match = re.search(r'\bmax-age=(\d+)', cache_control)
+    if match:
+        return int(match.group(1))
+    return None
+
+
+def url_jwks_fetcher(url, timeout=JWKS_FETCH_TIMEOUT):
+    # Fetcher returning (jwks, max_age) from an http(s) or file url
+    def fetch():
+        with urlopen(url, timeout=timeout) as response:
+            jwks = json.loads(response.read())
+            headers = getattr(response, 'headers', None)
+            cache_control = headers.get('Cache-Control') if headers else None
+        return jwks, parse_max_age(cache_control)
+    return fetch
+
+
+def file_jwks_fetcher(path):
+    # Fetcher reading a local JWKS document, handy for tests and benchmarks
+    def fetch():
+        with open(path) as jwks_file:
+            return json.load(jwks_file), None
+    return fetch
+
+
+'''
+JWKSKeyStore
+A process-wide cache of the signing keys published by Auth0.
+Keys are built once per kid, kept for the Cache-Control max-age
+(or JWKS_CACHE_TTL) and refreshed in the background shortly before
+they expire. An unknown kid triggers a refetch, at most once every
+min_refresh_interval seconds.
+'''
+class JWKSKeyStore:
+    def __init__(self, fetcher, ttl=JWKS_CACHE_TTL,
+                 min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL,
+                 refresh_ahead=0.8, clock=time.monotonic):
+        self.fetcher = fetcher
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.refresh_ahead = refresh_ahead
+        self.clock = clock
+        self.keys = {}
+        self.fetches = 0
+        # Bumped whenever the set of kids changes, used to drop cached tokens
+        self.generation = 0
+        self._fetched_at = None
+        self._expires_at = 0
+        self._fetch_lock = threading.Lock()
+        self._refreshing = False
+
+    def get_key(self, kid):
+        now = self.clock()
+        if self._fetched_at is None or now >= self._expires_at:
+            self.refresh(force=False)
+        elif now >= self._refresh_at():
+            self._refresh_in_background()
+
+        key = self.keys.get(kid)
+        if key is None and self._can_refetch():
+            # The key set may have been rotated since the last fetch
+            self.refresh(force=False)
+            key = self.keys.get(kid)
+        if not self.keys:
+            # The fetch failed and is throttled, there is nothing to check the token against
+            raise LookupError('no signing keys, the last JWKS fetch failed')
+        return key
+
+    def refresh(self, force=True):
+        with self._fetch_lock:
+            if not force and not self._can_refetch():
+                return
+            try:
+                jwks, max_age = self.fetcher()
+            except Exception:
+                self._fetched_at = self.clock()
+                if not self.keys:
+                    raise
+                # Keep serving the keys we already have
+                self._expires_at = self._fetched_at + self.min_refresh_interval
+                return
+            self.fetches += 1
+            keys = self._build_keys(jwks)
+            if keys.keys() != self.keys.keys():
+                self.generation += 1
+            self.keys = keys
+            self._fetched_at = self.clock()
+            ttl = self.ttl if max_age is None else max_age
+            self._expires_at = self._fetched_at + max(ttl, self.min_refresh_interval)
+
+    def clear(self):
+        with self._fetch_lock:
+            self.keys = {}
+            self.generation += 1
+            self._fetched_at = None
+            self._expires_at = 0
+
+    def _build_keys(self, jwks):
+        keys = {}
+        for key in jwks.get('keys', []):
+            if 'kid' not in key or key.get('use', 'sig') != 'sig':
+                continue
+            try:
+                keys[key['kid']] = jwk.construct(key, key.get('alg', ALGORITHMS))
+            except Exception:
+                continue
+        return keys
+
+    def _refresh_at(self):
+        return self._fetched_at + (self._expires_at - self._fetched_at) * self.refresh_ahead
+
+    def _can_refetch(self):
+        return self._fetched_at is None or \
+            self.clock() - self._fetched_at >= self.min_refresh_interval
+
+    def _refresh_in_background(self):
+        if self._refreshing:
+            return
+        self._refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            except Exception:
+                pass
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+
+jwks_store = JWKSKeyStore(url_jwks_fetcher(JWKS_URL))
+
+
+def set_jwks_fetcher(fetcher):
+    # Swaps the JWKS source, e.g. for a local file or stub server
+    jwks_store.fetcher = fetcher
+    jwks_store.clear()
+
+
+'''
+TokenCache
+A bounded LRU of verified token payloads keyed by a sha256 of the token.
+Entries live until the token's exp or max_ttl, whichever comes first,
+and are all dropped when the JWKS key set rotates.
+'''
+class TokenCache:
+    def __init__(self, key_store, maxsize=TOKEN_CACHE_SIZE,
+                 max_ttl=TOKEN_CACHE_MAX_TTL, clock=time.time):
+        self.key_store = key_store
+        self.maxsize = maxsize
+        self.max_ttl = max_ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._generation = key_store.generation
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        if self.maxsize <= 0:
+            return None
+        digest = self._digest(token)
+        with self._lock:
+            self._check_generation()
+            entry = self._entries.get(digest)
+            if entry is None:
+                self.misses += 1
+                return None
+            payload, expires_at = entry
+            if self.clock() >= expires_at:
+                del self._entries[digest]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(digest)
+            self.hits += 1
+            return payload
+
+    def put(self, token, payload):
+        if self.maxsize <= 0:
+            return
+        expires_at = self.clock() + self.max_ttl
+        if 'exp' in payload:
+            expires_at = min(expires_at, payload['exp'])
+        digest = self._digest(token)
+        with self._lock:
+            self._check_generation()
+            self._entries[digest] = (payload, expires_at)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+    def _check_generation(self):
+        if self._generation != self.key_store.generation:
+            self._entries.clear()
+            self._generation = self.key_store.generation
+
+    @staticmethod
+    def _digest(token):
+        return hashlib.sha256(token.encode('utf-8')).digest()
+
+
+token_cache = TokenCache(jwks_store)
+
+
 ## Auth Header
 def get_token_auth_header():
     # Obtains the Access Token from the Authorization Header
@@ -71,25 +315,31 @@ def check_permissions(permission, payload):
     return True
 
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
-    unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
+    # Tokens verified before skip the signature and claims checks
+    cached_payload = token_cache.get(token)
+    if cached_payload is not None:
+        return cached_payload
+
+    try:
+        unverified_header = jwt.get_unverified_header(token)
+    except Exception:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Unable to parse authentication token.'
+        }, 400)
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    try:
+        rsa_key = jwks_store.get_key(unverified_header['kid'])
+    except Exception:
+        raise AuthError({
+            'code': 'jwks_unavailable',
+            'description': 'Unable to fetch the signing keys.'
+        }, 503)
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -99,6 +349,7 @@ def verify_decode_jwt(token):
                 audience=API_AUDIENCE,
                 issuer='https://' + AUTH0_DOMAIN + '/'
             )
+            token_cache.put(token, payload)
 
             return payload
 
@@ -127,9 +378,10 @@ def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            with timed_phase('auth'):
+                token = get_token_auth_header()
+                payload = verify_decode_jwt(token)
+                check_permissions(permission, payload)
             return f(payload, *args, **kwargs)
         return wrapper
     return requires_auth_decorator
\ No newline at end of file
@@ -0,0 +1,280 @@
+'''
+Load test and benchmark for every route of the API.
+
+Runs fully offline: tokens are minted with a local RS256 key and the JWKS
+is served from a local port, the database is a temporary SQLite file
+unless --database points at a (local) Postgres. Prints throughput and
+p50/p95/p99 latency per route as json, and exits with 1 when a saved
+baseline regressed by more than --max-regression percent.
+
+    python benchmark.py --actors 10000 --movies 10000 --requests 500 --concurrency 16
+    python benchmark.py --save-baseline bench_baseline.json
+    python benchmark.py --baseline bench_baseline.json --max-regression 20
+'''
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+from urllib.request import Request, HTTPRedirectHandler, build_opener
+from urllib.error import HTTPError
+
+from local_auth import LocalSigningKey, serve_jwks
+
+# Redirects (GET /login) are not followed, the app's answer is what counts
+class NoRedirect(HTTPRedirectHandler):
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+opener = build_opener(NoRedirect)
+
+PERMISSIONS = [
+    'create:actors', 'create:movies', 'delete:actors', 'delete:movies',
+    'edit:actors', 'edit:movies', 'read:actors', 'read:movies'
+]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark every route of the Capstone API')
+    parser.add_argument('--database', default=None,
+        help='Database url, defaults to a temporary SQLite file')
+    parser.add_argument('--actors', type=int, default=1000, help='Actors to seed')
+    parser.add_argument('--movies', type=int, default=1000, help='Movies to seed')
+    parser.add_argument('--requests', type=int, default=200, help='Requests per route')
+    parser.add_argument('--concurrency', type=int, default=8, help='Requests in flight at once')
+    parser.add_argument('--routes', default=None, help='Comma separated scenario names to run, defaults to all')
+    parser.add_argument('--output', default=None, help='Also write the report to this file')
+    parser.add_argument('--save-baseline', default=None, help='Save the report as a baseline to this file')
+    parser.add_argument('--baseline', default=None, help='Compare the report against this baseline')
+    parser.add_argument('--max-regression', type=float, default=20.0,
+        help='Percent a route\'s p95 or throughput can get worse before failing')
+    return parser.parse_args(argv)
+
+
+# The app reads its settings from the environment when it is imported,
+# so everything is set up before the first import
+def configure_environment(args, jwks_url):
+    if args.database is None:
+        args.database = 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='capstone-bench-'), 'bench.db')
+    os.environ['DATABASE_URL'] = args.database
+    os.environ['JWKS_URL'] = jwks_url
+    os.environ.setdefault('AUTH0_DOMAIN', 'benchmark.local')
+    os.environ.setdefault('ALGORITHMS', 'RS256')
+    os.environ.setdefault('API_AUDIENCE', 'https://NoahCapstone')
+    os.environ.setdefault('LOGIN_LINK', 'https://benchmark.local/authorize')
+
+
+def seed(app, actors, movies):
+    from models import db, bump_table_version, Actors, Movies
+    from app import encode_since
+    with app.app_context():
+        for start in range(0, actors, 1000):
+            db.session.execute(Actors.__table__.insert(), [
+                {'name': 'Actor {}'.format(number), 'age': 18 + number % 60,
+                 'gender': ('Female', 'Male', 'Nonbinary')[number % 3], 'version': 1}
+                for number in range(start, min(start + 1000, actors))])
+        for start in range(0, movies, 1000):
+            db.session.execute(Movies.__table__.insert(), [
+                {'title': 'Movie {}'.format(number),
+                 'release_date': '{}-{:02d}-{:02d}'.format(1980 + number % 45, 1 + number % 12, 1 + number % 28),
+                 'version': 1}
+                for number in range(start, min(start + 1000, movies))])
+        bump_table_version('actors')
+        bump_table_version('movies')
+        db.session.commit()
+        first_actor = db.session.query(db.func.min(Actors.id)).scalar()
+        first_movie = db.session.query(db.func.min(Movies.id)).scalar()
+        # The last change of each table, the changes routes sync from there
+        # like a client that is up to date
+        synced = {model.__tablename__: encode_since(*db.session.query(model.change_seq, model.id).order_by(
+            model.change_seq.desc(), model.id.desc()).first()) for model in (Actors, Movies)}
+    return first_actor, first_movie, synced
+
+
+# Every scenario returns (method, path, json body) for the i-th request.
+# Deletes walk through the seeded ids from the end so each one hits a row
+def scenarios(args, first_actor, first_movie, synced):
+    last_actor = first_actor + args.actors - 1
+    last_movie = first_movie + args.movies - 1
+    return {
+        'root': lambda i: ('GET', '/', None),
+        'login': lambda i: ('GET', '/login', None),
+        'auth': lambda i: ('GET', '/auth', None),
+        'list_actors': lambda i: ('GET', '/actors?limit=50', None),
+        'list_actors_filtered': lambda i: ('GET', '/actors?gender=Female&age_min=25&age_max=35&limit=50', None),
+        'list_actors_include_movies': lambda i: ('GET', '/actors?include=movies&limit=50', None),
+        'stream_actors': lambda i: ('GET', '/actors?stream=1&fields=name', None),
+        'get_actor': lambda i: ('GET', '/actors/{}'.format(first_actor + i % args.actors), None),
+        'list_movies': lambda i: ('GET', '/movies?limit=50', None),
+        'list_movies_by_date': lambda i: ('GET', '/movies?released_after=2000-01-01&sort=release_date&limit=50', None),
+        'list_movies_include_cast': lambda i: ('GET', '/movies?include=cast&limit=50', None),
+        'get_movie': lambda i: ('GET', '/movies/{}'.format(first_movie + i % args.movies), None),
+        'actor_changes': lambda i: ('GET', '/actors/changes?limit=50&since=' + synced['actors'], None),
+        'movie_changes': lambda i: ('GET', '/movies/changes?limit=50&since=' + synced['movies'], None),
+        'search': lambda i: ('GET', '/search?q=' + quote('Movie {}'.format(i % args.movies)), None),
+        'create_actor': lambda i: ('POST', '/actors', {'name': 'New Actor {}'.format(i), 'age': 30, 'gender': 'Female'}),
+        'create_movie': lambda i: ('POST', '/movies', {'title': 'New Movie {}'.format(i), 'release_date': '2024-01-01'}),
+        'bulk_create_actors': lambda i: ('POST', '/actors/bulk',
+            [{'name': 'Bulk Actor {}-{}'.format(i, n), 'age': 40, 'gender': 'Male'} for n in range(20)]),
+        'bulk_create_movies': lambda i: ('POST', '/movies/bulk',
+            [{'title': 'Bulk Movie {}-{}'.format(i, n), 'release_date': '2023-06-01'} for n in range(20)]),
+        'edit_actor': lambda i: ('PATCH', '/actors', {'id': first_actor + i % args.actors, 'age': 20 + i % 50}),
+        'edit_movie': lambda i: ('PATCH', '/movies', {'id': first_movie + i % args.movies, 'title': 'Edited {}'.format(i)}),
+        'batch': lambda i: ('POST', '/batch', [
+            {'action': 'create', 'type': 'actor', 'name': 'Batch Actor {}'.format(i), 'age': 30, 'gender': 'Male'},
+            {'action': 'edit', 'type': 'movie', 'id': first_movie + i % args.movies, 'title': 'Batched {}'.format(i)}]),
+        'assign_cast': lambda i: ('POST', '/cast',
+            [{'movie_id': first_movie + i % args.movies, 'actor_id': first_actor + (i * 7 + n) % args.actors} for n in range(5)]),
+        'unassign_cast': lambda i: ('DELETE', '/cast',
+            [{'movie_id': first_movie + i % args.movies, 'actor_id': first_actor + (i * 7 + n) % args.actors} for n in range(5)]),
+        'metrics': lambda i: ('GET', '/metrics', None),
+        'delete_actor': lambda i: ('DELETE', '/actors/delete', {'id': last_actor - i}),
+        'axios_delete_actor': lambda i: ('DELETE', '/actors?id={}'.format(last_actor - args.requests - i), None),
+        'delete_movie': lambda i: ('DELETE', '/movies/delete', {'id': last_movie - i}),
+        'axios_delete_movie': lambda i: ('DELETE', '/movies?id={}'.format(last_movie - args.requests - i), None),
+    }
+
+
+def send(base_url, token, method, path, body):
+    data = json.dumps(body).encode('utf-8') if body is not None else None
+    request = Request(base_url + path, data=data, method=method, headers={
+        'Authorization': 'Bearer ' + token,
+        'Content-Type': 'application/json'
+    })
+    start = time.perf_counter()
+    try:
+        with opener.open(request) as response:
+            response.read()
+            status = response.status
+    except HTTPError as error:
+        error.read()
+        status = error.code
+        if 300 <= status < 400:
+            status = 200
+    return time.perf_counter() - start, status
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    # Nearest rank
+    index = min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def run_scenario(base_url, token, scenario, requests, concurrency):
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def one(i):
+        nonlocal errors
+        method, path, body = scenario(i)
+        elapsed, status = send(base_url, token, method, path, body)
+        with lock:
+            latencies.append(elapsed)
+            if status >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(requests)))
+    wall = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'requests': requests,
+        'errors': errors,
+        'throughput_rps': round(requests / wall, 2) if wall else 0.0,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3)
+    }
+
+
+# Returns a list of regressions of report against baseline, empty when it held up
+def compare(report, baseline, max_regression):
+    regressions = []
+    allowed = max_regression / 100.0
+    for name, before in baseline['routes'].items():
+        after = report['routes'].get(name, None)
+        if after is None:
+            continue
+        if before['p95_ms'] and after['p95_ms'] > before['p95_ms'] * (1 + allowed):
+            regressions.append('{}: p95 {}ms -> {}ms'.format(name, before['p95_ms'], after['p95_ms']))
+        if before['throughput_rps'] and after['throughput_rps'] < before['throughput_rps'] * (1 - allowed):
+            regressions.append('{}: throughput {}/s -> {}/s'.format(
+                name, before['throughput_rps'], after['throughput_rps']))
+    return regressions
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if 2 * args.requests >= min(args.actors, args.movies):
+        sys.exit('--actors and --movies must be more than twice --requests, the delete routes need the rows')
+
+    signing_key = LocalSigningKey()
+    jwks_server, jwks_url = serve_jwks(signing_key.jwks())
+    configure_environment(args, jwks_url)
+
+    from werkzeug.serving import make_server, WSGIRequestHandler
+    from app import app
+    first_actor, first_movie, synced = seed(app, args.actors, args.movies)
+    token = signing_key.mint(os.environ['AUTH0_DOMAIN'], os.environ['API_AUDIENCE'], PERMISSIONS)
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = 'http://127.0.0.1:{}'.format(server.server_port)
+
+    selected = scenarios(args, first_actor, first_movie, synced)
+    if args.routes:
+        names = [name.strip() for name in args.routes.split(',')]
+        unknown = [name for name in names if name not in selected]
+        if unknown:
+            sys.exit('unknown routes: ' + ', '.join(unknown))
+        selected = {name: selected[name] for name in names}
+
+    report = {
+        'settings': {
+            'database': args.database.split(':', 1)[0],
+            'actors': args.actors,
+            'movies': args.movies,
+            'requests': args.requests,
+            'concurrency': args.concurrency
+        },
+        'routes': {}
+    }
+    try:
+        for name, scenario in selected.items():
+            report['routes'][name] = run_scenario(base_url, token, scenario, args.requests, args.concurrency)
+    finally:
+        server.shutdown()
+        jwks_server.shutdown()
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    print(output)
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as report_file:
+                report_file.write(output + '\n')
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(report, json.load(baseline_file), args.max_regression)
+        for regression in regressions:
+            print('REGRESSION ' + regression, file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
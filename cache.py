@@ -0,0 +1,163 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from functools import wraps
+from flask import request, make_response
+
+
+# Set to false to turn the response cache off while debugging
+RESPONSE_CACHE_ENABLED = os.environ.get('RESPONSE_CACHE_ENABLED', 'true').lower() not in ('0', 'false', 'no')
+# Most responses kept in memory
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 512))
+# Most response bytes kept in memory
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+# Seconds a response is kept, 0 keeps it until it is invalidated or evicted
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', 0))
+
+
+'''
+MemoryCacheBackend
+An LRU bounded by entry count and total bytes, with an optional ttl.
+Entries are tagged (by table name) so writes can drop exactly the
+entries they make stale. Another backend (e.g. a shared one) only needs
+the same get/set/invalidate/clear/stats methods.
+'''
+class MemoryCacheBackend:
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE, max_bytes=RESPONSE_CACHE_MAX_BYTES,
+                 clock=time.monotonic):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, size, tag, expires_at = entry
+            if expires_at is not None and self.clock() >= expires_at:
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, size, tag, ttl=0):
+        if size > self.max_bytes:
+            return
+        expires_at = self.clock() + ttl if ttl else None
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, tag, expires_at)
+            self._tags.setdefault(tag, set()).add(key)
+            self._bytes += size
+            while len(self._entries) > self.maxsize or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, tag):
+        with self._lock:
+            for key in self._tags.pop(tag, ()):
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+            self._bytes = 0
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'bytes': self._bytes,
+            'evictions': self.evictions
+        }
+
+    def _remove(self, key):
+        value, size, tag, expires_at = self._entries.pop(key)
+        self._bytes -= size
+        keys = self._tags.get(tag)
+        if keys:
+            keys.discard(key)
+            if not keys:
+                del self._tags[tag]
+
+
+'''
+ResponseCache
+Caches the json bodies of read endpoints, keyed by path, query string,
+Accept type, the token's permissions and the table's ETag. Because the
+ETag comes from the table's change counter, a write made through another
+worker process also stops old entries from being served.
+'''
+class ResponseCache:
+    def __init__(self, backend, enabled=RESPONSE_CACHE_ENABLED, ttl=RESPONSE_CACHE_TTL):
+        self.backend = backend
+        self.enabled = enabled
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    # Decorator for a view taking the auth payload, goes under requires_auth.
+    # etag_of(tag) returns the current ETag of the tagged table
+    def cached(self, tag, etag_of):
+        def cached_decorator(f):
+            @wraps(f)
+            def wrapper(payload, *args, **kwargs):
+                if not self.enabled:
+                    return f(payload, *args, **kwargs)
+
+                etag = etag_of(tag)
+                key = (
+                    request.path,
+                    request.query_string,
+                    request.accept_mimetypes.best,
+                    tuple(sorted(payload.get('permissions', []))),
+                    etag
+                )
+                entry = self.backend.get(key)
+                if entry is not None:
+                    self.hits += 1
+                    body, response_etag = entry
+                    response = make_response(body)
+                    response.mimetype = 'application/json'
+                    response.set_etag(response_etag)
+                    return response.make_conditional(request)
+
+                self.misses += 1
+                response = make_response(f(payload, *args, **kwargs))
+                if response.status_code == 200 and not response.is_streamed and \
+                        response.mimetype == 'application/json':
+                    body = response.get_data()
+                    # The response may carry its own ETag, e.g. a row version
+                    response_etag = response.get_etag()[0] or etag
+                    self.backend.set(key, (body, response_etag), len(body), tag, self.ttl)
+                return response
+            return wrapper
+        return cached_decorator
+
+    def invalidate(self, tag):
+        self.backend.invalidate(tag)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        stats = {
+            'enabled': self.enabled,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+        stats.update(self.backend.stats())
+        return stats
+
+
+response_cache = ResponseCache(MemoryCacheBackend())
@@ -0,0 +1,240 @@
+import io
+import csv
+import json
+from sqlalchemy import func
+from models import db, bump_table_version, parse_release_date, format_date, Actors, Movies
+
+
+# Rows written per batch (and per transaction when importing)
+TRANSFER_BATCH_SIZE = 10000
+
+# What can be exported and imported, with the columns in file order
+TRANSFER_TABLES = {
+    'actors': (Actors, ('id', 'name', 'age', 'gender')),
+    'movies': (Movies, ('id', 'title', 'release_date')),
+}
+TRANSFER_FORMATS = ('csv', 'ndjson')
+
+
+def transfer_table(name):
+    if name not in TRANSFER_TABLES:
+        raise ValueError('unknown table {!r}, expected one of {}'.format(name, ', '.join(TRANSFER_TABLES)))
+    return TRANSFER_TABLES[name]
+
+def check_format(file_format):
+    if file_format not in TRANSFER_FORMATS:
+        raise ValueError('unknown format {!r}, expected csv or ndjson'.format(file_format))
+
+def is_postgres():
+    return db.engine.dialect.name == 'postgresql'
+
+
+## Export
+def export_table(name, file_format, output, batch_size=TRANSFER_BATCH_SIZE, progress=None):
+    # Writes every row of the table to output in id order, returns the row count
+    check_format(file_format)
+    model, columns = transfer_table(name)
+    if is_postgres():
+        return copy_out(model, columns, file_format, output, progress)
+
+    writer = csv.writer(output) if file_format == 'csv' else None
+    if writer is not None:
+        writer.writerow(columns)
+    count = 0
+    query = db.session.query(*[getattr(model, column) for column in columns]).order_by(model.id)
+    for row in query.yield_per(batch_size):
+        values = [format_date(value) if column == 'release_date' else value
+            for column, value in zip(columns, row)]
+        if writer is not None:
+            writer.writerow(values)
+        else:
+            output.write(json.dumps(dict(zip(columns, values))) + '\n')
+        count += 1
+        if progress is not None and count % batch_size == 0:
+            progress(count)
+    if progress is not None:
+        progress(count)
+    return count
+
+def copy_out(model, columns, file_format, output, progress=None):
+    select = 'SELECT {} FROM {} ORDER BY id'.format(', '.join(columns), model.__tablename__)
+    if file_format == 'csv':
+        statement = 'COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER true)'.format(select)
+    else:
+        # JSON never holds raw control characters, so with these as the CSV
+        # delimiter and quote every line comes out exactly as row_to_json made it
+        statement = "COPY (SELECT row_to_json(row) FROM ({}) row) TO STDOUT " \
+            "WITH (FORMAT csv, DELIMITER E'\\x02', QUOTE E'\\x01')".format(select)
+    counter = LineCounter(output, progress)
+    connection = db.engine.raw_connection()
+    try:
+        connection.cursor().copy_expert(statement, counter)
+        connection.commit()
+    finally:
+        connection.close()
+    if progress is not None:
+        progress(counter.lines)
+    return counter.lines - (1 if file_format == 'csv' else 0)
+
+'''
+LineCounter
+Passes what COPY writes through to a text file, counting lines for
+progress reports. Quoted CSV values with line breaks make the count
+approximate. psycopg2 only writes str to io.TextIOBase objects, bytes
+are decoded in case a driver sends them anyway.
+'''
+class LineCounter(io.TextIOBase):
+    def __init__(self, output, progress=None, every=TRANSFER_BATCH_SIZE):
+        self.output = output
+        self.progress = progress
+        self.every = every
+        self.lines = 0
+        self._reported = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            data = bytes(data).decode('utf-8')
+        self.output.write(data)
+        self.lines += data.count('\n')
+        if self.progress is not None and self.lines - self._reported >= self.every:
+            self._reported = self.lines
+            self.progress(self.lines)
+        return len(data)
+
+
+## Import
+'''
+ImportRecordError
+A record of an import file is invalid. The records before it were
+imported, offset is the --offset that resumes the import at this record.
+'''
+class ImportRecordError(ValueError):
+    def __init__(self, offset, errors):
+        self.offset = offset
+        self.errors = errors
+        super().__init__('record {} is invalid: {}. The records before it were imported, '
+            'fix it and resume with --offset {}'.format(offset + 1, '; '.join(errors), offset))
+
+
+def read_records(file_format, source):
+    # Yields one dict per record of the file, empty CSV values are null.
+    # A line that isn't json is yielded as None
+    if file_format == 'csv':
+        for record in csv.DictReader(source):
+            yield {key: (value if value != '' else None) for key, value in record.items()}
+        return
+    for line in source:
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield None
+
+def convert_value(column, value):
+    if column == 'release_date':
+        return parse_release_date(value)
+    if isinstance(value, str) and value.strip().lstrip('-').isdigit():
+        return int(value)
+    if type(value) is not int:
+        raise ValueError('{} must be an integer'.format(column))
+    return value
+
+def convert_record(model, record, columns):
+    # Returns the record as a row of the table and a list of its problems,
+    # checked like the bulk endpoints check theirs
+    if not isinstance(record, dict):
+        return None, ['record must be a json object']
+    row = {}
+    errors = []
+    for column in columns:
+        value = record.get(column, None)
+        if value is not None and column in ('id', 'age', 'release_date'):
+            try:
+                value = convert_value(column, value)
+            except ValueError:
+                errors.append('release_date must be a date, like 2015-05-29' if column == 'release_date'
+                    else '{} must be an integer'.format(column))
+                continue
+        row[column] = value
+    # Columns that didn't convert are left out, validate() skips missing ones
+    return row, errors + model.validate(row)
+
+def import_table(name, file_format, source, batch_size=TRANSFER_BATCH_SIZE, offset=0, progress=None):
+    # Adds the records of source to the table, one transaction per batch.
+    # The first offset records are skipped, so an interrupted import resumes
+    # with the offset it last reported. Returns the number of records added,
+    # an invalid record raises ImportRecordError once the ones before it are in
+    check_format(file_format)
+    model, columns = transfer_table(name)
+    records = read_records(file_format, source)
+    columns_in_file = None
+    batch = []
+    position = 0
+    count = 0
+    for record in records:
+        position += 1
+        if position <= offset:
+            continue
+        if columns_in_file is None and isinstance(record, dict):
+            unknown = sorted(set(record) - set(columns))
+            if unknown:
+                raise ValueError('unknown columns for {}: {}'.format(name, ', '.join(unknown)))
+            columns_in_file = [column for column in columns if column in record]
+        row, errors = convert_record(model, record, columns_in_file or ())
+        if errors:
+            if batch:
+                write_batch(model, columns_in_file, batch)
+                count += len(batch)
+                if progress is not None:
+                    progress(count, position - 1)
+            finish_import(model, columns_in_file or ())
+            raise ImportRecordError(position - 1, errors)
+        batch.append(row)
+        if len(batch) == batch_size:
+            write_batch(model, columns_in_file, batch)
+            count += len(batch)
+            batch = []
+            if progress is not None:
+                progress(count, position)
+    if batch:
+        write_batch(model, columns_in_file, batch)
+        count += len(batch)
+        if progress is not None:
+            progress(count, position)
+
+    finish_import(model, columns_in_file or ())
+    return count
+
+def write_batch(model, columns, rows):
+    if is_postgres():
+        copy_in(model, columns, rows)
+        return
+    with db.engine.begin() as connection:
+        connection.execute(model.__table__.insert(), rows)
+
+def copy_in(model, columns, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([format_date(row[column]) if column == 'release_date' else row[column]
+            for column in columns])
+    buffer.seek(0)
+    connection = db.engine.raw_connection()
+    try:
+        connection.cursor().copy_expert('COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+            model.__tablename__, ', '.join(columns)), buffer)
+        connection.commit()
+    finally:
+        connection.close()
+
+def finish_import(model, columns):
+    name = model.__tablename__
+    if 'id' in columns and is_postgres():
+        # Imported ids went past the sequence, move it after them
+        db.session.execute(func.setval(func.pg_get_serial_sequence(name, 'id'),
+            func.coalesce(db.session.query(func.max(model.id)).scalar_subquery(), 1)))
+    bump_table_version(name)
+    db.session.commit()
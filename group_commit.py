@@ -0,0 +1,110 @@
+import os
+import threading
+from models import db
+
+
+# Off by default. When on, single creates arriving together share one
+# transaction (and one commit) instead of committing one by one
+GROUP_COMMIT_ENABLED = os.environ.get('GROUP_COMMIT_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+# Longest a create waits for others to join its transaction, in milliseconds
+GROUP_COMMIT_WINDOW_MS = float(os.environ.get('GROUP_COMMIT_WINDOW_MS', 5))
+# A transaction is written as soon as this many rows joined it
+GROUP_COMMIT_MAX_ROWS = int(os.environ.get('GROUP_COMMIT_MAX_ROWS', 100))
+
+
+class _Ticket:
+    def __init__(self, row):
+        self.row = row
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+'''
+GroupCommitter
+Collects the rows of concurrent single-row creates into one transaction.
+The first caller of a group leads it: it waits up to the window (or until
+max_rows joined), writes every row of the group in its own session and
+commits once, while the others wait for their result. Each caller gets
+back what write() returned for its own row or the error its row raised.
+
+write(rows) inserts the rows without committing and returns one result
+per row, before_commit() runs once per transaction before the commit.
+'''
+class GroupCommitter:
+    def __init__(self, write, before_commit=None, window_ms=GROUP_COMMIT_WINDOW_MS,
+                 max_rows=GROUP_COMMIT_MAX_ROWS):
+        self.write = write
+        self.before_commit = before_commit
+        self.window = window_ms / 1000.0
+        self.max_rows = max_rows
+        self.commits = 0
+        self.rows = 0
+        self._pending = []
+        self._leading = False
+        self._condition = threading.Condition()
+
+    def submit(self, row):
+        ticket = _Ticket(row)
+        with self._condition:
+            self._pending.append(ticket)
+            leader = not self._leading
+            if leader:
+                self._leading = True
+            elif len(self._pending) >= self.max_rows:
+                self._condition.notify_all()
+
+        if leader:
+            with self._condition:
+                self._condition.wait_for(lambda: len(self._pending) >= self.max_rows, timeout=self.window)
+                group = self._pending
+                self._pending = []
+                # The next caller starts a new group while this one is written
+                self._leading = False
+            self._commit(group)
+        else:
+            ticket.done.wait()
+
+        if ticket.error is not None:
+            raise ticket.error
+        return ticket.result
+
+    def _commit(self, group):
+        try:
+            try:
+                results = self.write([ticket.row for ticket in group])
+                if self.before_commit is not None:
+                    self.before_commit()
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                # Some row is bad, write them one by one so only its caller fails
+                results = self._commit_one_by_one(group)
+            self.commits += 1
+            self.rows += len(group)
+            for ticket, result in zip(group, results):
+                ticket.result = result
+        except Exception as error:
+            for ticket in group:
+                ticket.error = error
+        finally:
+            for ticket in group:
+                ticket.done.set()
+
+    def _commit_one_by_one(self, group):
+        results = []
+        try:
+            for ticket in group:
+                try:
+                    with db.session.begin_nested():
+                        results.append(self.write([ticket.row])[0])
+                except Exception as error:
+                    ticket.error = error
+                    results.append(None)
+            if self.before_commit is not None:
+                self.before_commit()
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return results
@@ -0,0 +1,33 @@
+'''
+Gunicorn settings for the async serving mode:
+
+    gunicorn -c gunicorn_async.py app:app
+
+Runs the same app on gevent workers. Sockets are made cooperative, so a
+worker waiting on a client, on the JWKS fetch or on a Postgres round
+trip (psycopg2 through psycogreen) switches to other requests instead of
+blocking, and one process serves thousands of concurrent connections.
+'''
+import os
+import multiprocessing
+
+
+worker_class = 'gevent'
+# Worker processes, one per core is enough as they no longer block
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+# Most concurrent connections a worker serves
+worker_connections = int(os.environ.get('ASYNC_WORKER_CONNECTIONS', 1000))
+bind = os.environ.get('BIND', '0.0.0.0:' + os.environ.get('PORT', '8000'))
+# Slow clients are parked rather than holding a worker, so keep-alive is cheap
+keepalive = int(os.environ.get('ASYNC_KEEPALIVE', 5))
+
+
+def post_worker_init(worker):
+    # gevent's monkey patching covers sockets (urlopen, the JWKS fetch)
+    # but not libpq, psycogreen makes psycopg2 wait through gevent too
+    try:
+        from psycogreen.gevent import patch_psycopg
+    except ImportError:
+        worker.log.warning('psycogreen or psycopg2 is not installed, Postgres round trips will block the worker')
+        return
+    patch_psycopg()
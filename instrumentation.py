@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import logging
+from contextlib import contextmanager, nullcontext
+from flask import g, request, has_request_context
+from flask.json import JSONEncoder
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+# Off by default, nothing is hooked in unless this is turned on
+SQL_INSTRUMENTATION = os.environ.get('SQL_INSTRUMENTATION', 'false').lower() in ('1', 'true', 'yes')
+# Statements slower than this many milliseconds go to the slow query log
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+
+slow_query_logger = logging.getLogger('capstone.slow_query')
+
+_NULL_PHASE = nullcontext()
+
+
+## Request timings
+def request_timings():
+    # The timings of the current request, None outside of a request
+    if not has_request_context():
+        return None
+    timings = g.get('timings', None)
+    if timings is None:
+        timings = g.timings = {'auth': 0.0, 'db': 0.0, 'serialize': 0.0, 'queries': 0}
+    return timings
+
+def add_timing(phase, seconds):
+    timings = request_timings()
+    if timings is not None:
+        timings[phase] += seconds
+
+@contextmanager
+def _timed(phase):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_timing(phase, time.perf_counter() - start)
+
+def timed_phase(phase):
+    # Context manager adding its run time to a phase of the request,
+    # free when instrumentation is off
+    if not SQL_INSTRUMENTATION:
+        return _NULL_PHASE
+    return _timed(phase)
+
+
+## SQL hooks
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start_time'].pop()
+    timings = request_timings()
+    if timings is not None:
+        timings['db'] += elapsed
+        timings['queries'] += 1
+    if elapsed * 1000 >= SLOW_QUERY_MS:
+        log_slow_query(statement, parameters, elapsed, executemany)
+
+def redact(parameters):
+    # Keeps the shape and types of the parameters, never their values
+    if isinstance(parameters, dict):
+        return {key: type(value).__name__ for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [redact(value) if isinstance(value, (dict, list, tuple)) else type(value).__name__
+            for value in parameters]
+    return type(parameters).__name__
+
+def log_slow_query(statement, parameters, elapsed, executemany=False):
+    record = {
+        'event': 'slow_query',
+        'duration_ms': round(elapsed * 1000, 3),
+        'statement': ' '.join(statement.split()),
+        'parameters': redact(parameters),
+        'executemany': executemany
+    }
+    if has_request_context():
+        record['method'] = request.method
+        record['path'] = request.path
+    slow_query_logger.warning(json.dumps(record))
+
+
+'''
+TimedJSONEncoder
+Flask's JSON encoder, counting the time jsonify spends encoding
+as the serialize phase of the request
+'''
+class TimedJSONEncoder(JSONEncoder):
+    def encode(self, o):
+        start = time.perf_counter()
+        try:
+            return super().encode(o)
+        finally:
+            add_timing('serialize', time.perf_counter() - start)
+
+
+def server_timing(timings, total):
+    return ', '.join([
+        'auth;dur={:.2f}'.format(timings['auth'] * 1000),
+        'db;dur={:.2f};desc="{} queries"'.format(timings['db'] * 1000, timings['queries']),
+        'serialize;dur={:.2f}'.format(timings['serialize'] * 1000),
+        'total;dur={:.2f}'.format(total * 1000)
+    ])
+
+
+def init_instrumentation(app):
+    # Hooks SQL timing, Server-Timing headers and the slow query log into
+    # the app, only when SQL_INSTRUMENTATION is on
+    if not SQL_INSTRUMENTATION:
+        return
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    app.json_encoder = TimedJSONEncoder
+
+    @app.before_request
+    def start_timings():
+        g.request_started = time.perf_counter()
+        request_timings()
+
+    @app.after_request
+    def add_server_timing(response):
+        timings = request_timings()
+        started = g.get('request_started', None)
+        if timings is not None and started is not None:
+            response.headers['Server-Timing'] = server_timing(timings, time.perf_counter() - started)
+        return response
@@ -0,0 +1,62 @@
+import json
+import time
+import uuid
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import rsa
+from jose import jwt, jwk
+
+
+'''
+LocalSigningKey
+An RS256 keypair made on the spot, standing in for the Auth0 tenant so
+tokens can be minted and checked offline (benchmarks, CI)
+'''
+class LocalSigningKey:
+    def __init__(self, kid=None, bits=2048):
+        self.kid = kid or uuid.uuid4().hex
+        public_key, private_key = rsa.newkeys(bits)
+        self.private_pem = private_key.save_pkcs1()
+
+    def jwks(self):
+        key = jwk.construct(self.private_pem, 'RS256').public_key().to_dict()
+        key.update({'kid': self.kid, 'use': 'sig', 'alg': 'RS256'})
+        return {'keys': [key]}
+
+    def mint(self, domain, audience, permissions=(), expires_in=3600, subject='local|benchmark'):
+        now = int(time.time())
+        claims = {
+            'iss': 'https://' + domain + '/',
+            'aud': audience,
+            'sub': subject,
+            'iat': now,
+            'exp': now + expires_in,
+            'scope': '',
+            'permissions': list(permissions)
+        }
+        return jwt.encode(claims, self.private_pem, algorithm='RS256', headers={'kid': self.kid})
+
+
+'''
+serve_jwks(jwks)
+    serves the JWKS document on a local port from a background thread,
+    returns the server and the url to point JWKS_URL at
+'''
+def serve_jwks(jwks, max_age=600):
+    body = json.dumps(jwks).encode('utf-8')
+
+    class JWKSHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Cache-Control', 'max-age={}'.format(max_age))
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), JWKSHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{}/.well-known/jwks.json'.format(server.server_address[1])
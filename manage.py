@@ -1,8 +1,12 @@
-from flask_script import Manager
+import sys
+from flask_script import Manager, Command, Option
 from flask_migrate import Migrate, MigrateCommand
+from sqlalchemy import inspect, text, Date
 
 from app import app
-from models import db
+from models import db, parse_release_date, Movies
+from data_transfer import export_table, import_table, ImportRecordError, TRANSFER_TABLES, TRANSFER_FORMATS, \
+    TRANSFER_BATCH_SIZE
 
 migrate = Migrate(app, db)
 manager = Manager(app)
@@ -10,5 +14,118 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+def open_file(path, mode):
+    # '-' is stdin or stdout
+    if path == '-':
+        return sys.stdin if mode == 'r' else sys.stdout
+    return open(path, mode, newline='', encoding='utf-8')
+
+def transfer_options(file_option):
+    return (
+        Option('table', choices=list(TRANSFER_TABLES), help='actors or movies'),
+        file_option,
+        Option('--format', dest='file_format', choices=TRANSFER_FORMATS, default='ndjson',
+               help='csv or ndjson (default ndjson)'),
+        Option('--batch-size', dest='batch_size', type=int, default=TRANSFER_BATCH_SIZE,
+               help='Rows per batch, and per transaction when importing'),
+    )
+
+
+# Writes a whole table as CSV or NDJSON, with COPY on postgres.
+# Progress goes to stderr so the data can go to stdout
+class ExportData(Command):
+    option_list = transfer_options(
+        Option('--output', dest='path', default='-', help='File to write (default stdout)'))
+
+    def run(self, table, path, file_format, batch_size):
+        def progress(count):
+            print('exported {} {}'.format(count, table), file=sys.stderr)
+
+        output = open_file(path, 'w')
+        try:
+            count = export_table(table, file_format, output, batch_size, progress)
+        finally:
+            if output is not sys.stdout:
+                output.close()
+        print('exported {} {} in total'.format(count, table), file=sys.stderr)
+
+
+# Loads a CSV or NDJSON file into a table, one transaction per batch, with
+# COPY on postgres. An interrupted import is resumed with --offset set to
+# the last offset it reported
+class ImportData(Command):
+    option_list = transfer_options(
+        Option('--input', dest='path', default='-', help='File to read (default stdin)')) + (
+        Option('--offset', dest='offset', type=int, default=0,
+               help='Records at the start of the file to skip'),
+    )
+
+    def run(self, table, path, file_format, batch_size, offset):
+        def progress(count, position):
+            print('imported {} {}, resume with --offset {}'.format(count, table, position), file=sys.stderr)
+
+        source = open_file(path, 'r')
+        try:
+            count = import_table(table, file_format, source, batch_size, offset, progress)
+        except ImportRecordError as error:
+            sys.exit(str(error))
+        finally:
+            if source is not sys.stdin:
+                source.close()
+        print('imported {} {} in total'.format(count, table), file=sys.stderr)
+
+
+data_manager = Manager(usage='Export and import actors and movies')
+data_manager.add_command('export', ExportData())
+data_manager.add_command('import', ImportData())
+manager.add_command('data', data_manager)
+
+
+# Turns the old String(120) movies.release_date into a real DATE column.
+# Every row that can't be parsed is reported, and nothing is changed
+# unless --force is given, in which case those rows get a null date.
+@manager.option('--force', dest='force', action='store_true', default=False,
+                help='Set release dates that cannot be converted to null')
+def convert_release_dates(force=False):
+    columns = {column['name']: column for column in inspect(db.engine).get_columns('movies')}
+    if isinstance(columns['release_date']['type'], Date):
+        print('movies.release_date is already a date column')
+        return
+
+    with db.engine.begin() as connection:
+        rows = connection.execute(text('SELECT id, release_date FROM movies')).fetchall()
+        converted = []
+        failed = []
+        for movie_id, release_date in rows:
+            if release_date is None or not release_date.strip():
+                converted.append({'id': movie_id, 'release_date': None})
+                continue
+            try:
+                converted.append({'id': movie_id, 'release_date': parse_release_date(release_date)})
+            except ValueError:
+                failed.append((movie_id, release_date))
+                converted.append({'id': movie_id, 'release_date': None})
+
+        for movie_id, release_date in failed:
+            print('movie {}: could not convert release_date {!r}'.format(movie_id, release_date))
+        if failed and not force:
+            print('{} of {} movies could not be converted, nothing was changed. '
+                  'Fix them or rerun with --force to set them to null.'.format(len(failed), len(rows)))
+            return
+
+        connection.execute(text('ALTER TABLE movies ADD COLUMN release_date_converted DATE'))
+        if converted:
+            connection.execute(
+                text('UPDATE movies SET release_date_converted = :release_date WHERE id = :id'),
+                converted)
+        connection.execute(text('ALTER TABLE movies DROP COLUMN release_date'))
+        connection.execute(text('ALTER TABLE movies RENAME COLUMN release_date_converted TO release_date'))
+        for index in Movies.__table__.indexes:
+            if 'release_date' in index.columns:
+                index.create(bind=connection)
+
+    print('converted {} movies, {} set to null'.format(len(rows), len(failed)))
+
+
 if __name__ == '__main__':
-    manager.run()
\ No newline at end of file
+    manager.run()
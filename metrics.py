@@ -0,0 +1,220 @@
+import os
+import json
+import time
+import threading
+from flask import g, request
+from auth import token_cache
+from cache import response_cache
+from models import pool_stats, replica_router
+
+
+# Directory shared by the gunicorn workers, each one writes its own shard of
+# metrics there and /metrics adds them all up. Empty it when the app restarts.
+# Without it only the metrics of the process answering /metrics are shown
+METRICS_SHARD_DIR = os.environ.get('METRICS_SHARD_DIR', None)
+# Seconds between two shard writes of a worker
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 1))
+# When set, /metrics needs an 'Authorization: Bearer <METRICS_TOKEN>' header
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', None)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HELP = {
+    'capstone_http_requests_total': ('counter', 'Requests handled, by route, method and status'),
+    'capstone_http_request_duration_seconds': ('histogram', 'Request latency, by route and method'),
+    'capstone_auth_errors_total': ('counter', 'Requests refused by auth, by error code and status'),
+    'capstone_cache_hits_total': ('counter', 'Cache hits, by cache'),
+    'capstone_cache_misses_total': ('counter', 'Cache misses, by cache'),
+    'capstone_cache_evictions_total': ('counter', 'Cache evictions, by cache'),
+    'capstone_db_pool_size': ('gauge', 'Connections the pool keeps open, by worker'),
+    'capstone_db_pool_checked_out': ('gauge', 'Connections in use, by worker'),
+    'capstone_db_pool_overflow': ('gauge', 'Connections open beyond the pool size, by worker'),
+    'capstone_db_pool_waits_total': ('counter', 'Connections handed out by the pool, by worker'),
+    'capstone_db_pool_wait_seconds_total': ('counter', 'Time spent waiting for a connection, by worker'),
+    'capstone_db_pool_max_wait_seconds': ('gauge', 'Longest wait for a connection, by worker'),
+    'capstone_db_pool_timeouts_total': ('counter', 'Requests that gave up waiting for a connection, by worker'),
+    'capstone_db_replicas_healthy': ('gauge', 'Read replicas taking reads, by worker'),
+    'capstone_db_replica_ejections_total': ('counter', 'Times a read replica was taken out, by worker'),
+}
+
+# pool_stats() keys and the metrics they are shown as
+POOL_METRICS = {
+    'size': 'capstone_db_pool_size',
+    'checked_out': 'capstone_db_pool_checked_out',
+    'overflow': 'capstone_db_pool_overflow',
+    'waits': 'capstone_db_pool_waits_total',
+    'wait_seconds': 'capstone_db_pool_wait_seconds_total',
+    'max_wait_seconds': 'capstone_db_pool_max_wait_seconds',
+    'timeouts': 'capstone_db_pool_timeouts_total',
+}
+
+
+'''
+MetricsRegistry
+Counters, gauges and latency histograms of one process. Samples are
+keyed by metric name and a sorted tuple of label pairs.
+'''
+class MetricsRegistry:
+    def __init__(self, shard_dir=METRICS_SHARD_DIR, buckets=LATENCY_BUCKETS):
+        self.shard_dir = shard_dir
+        self.buckets = buckets
+        self.samples = {}
+        self.histograms = {}
+        self._last_flush = 0
+        self._lock = threading.Lock()
+
+    def inc(self, name, labels, amount=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.samples[key] = self.samples.get(key, 0) + amount
+
+    def set(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.samples[key] = value
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key, None)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * len(self.buckets) + [0, 0.0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[index] += 1
+            histogram[-2] += 1
+            histogram[-1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'samples': [[name, list(labels), value] for (name, labels), value in self.samples.items()],
+                'histograms': [[name, list(labels), list(values)] for (name, labels), values in self.histograms.items()]
+            }
+
+    def flush_due(self):
+        return bool(self.shard_dir) and time.monotonic() - self._last_flush >= METRICS_FLUSH_INTERVAL
+
+    # Writes this process' shard
+    def flush(self):
+        if not self.shard_dir:
+            return
+        self._last_flush = time.monotonic()
+        os.makedirs(self.shard_dir, exist_ok=True)
+        path = os.path.join(self.shard_dir, 'metrics-{}.json'.format(os.getpid()))
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'w') as shard:
+            json.dump(self.snapshot(), shard)
+        os.replace(temporary_path, path)
+
+    # Adds up the shards of every worker (or just this process without a shard dir)
+    def collect(self):
+        if not self.shard_dir:
+            snapshots = [self.snapshot()]
+        else:
+            self.flush()
+            snapshots = []
+            for filename in sorted(os.listdir(self.shard_dir)):
+                if filename.startswith('metrics-') and filename.endswith('.json'):
+                    try:
+                        with open(os.path.join(self.shard_dir, filename)) as shard:
+                            snapshots.append(json.load(shard))
+                    except (OSError, ValueError):
+                        continue
+
+        samples = {}
+        histograms = {}
+        for snapshot in snapshots:
+            for name, labels, value in snapshot['samples']:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                samples[key] = samples.get(key, 0) + value
+            for name, labels, values in snapshot['histograms']:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                if key in histograms:
+                    histograms[key] = [total + value for total, value in zip(histograms[key], values)]
+                else:
+                    histograms[key] = list(values)
+        return samples, histograms
+
+    def render(self):
+        samples, histograms = self.collect()
+        lines = []
+        names = sorted({name for name, labels in samples} | {name for name, labels in histograms})
+        for name in names:
+            metric_type, description = HELP.get(name, ('untyped', name))
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            for (sample_name, labels), value in sorted(samples.items()):
+                if sample_name == name:
+                    lines.append('{}{} {}'.format(name, format_labels(labels), format_value(value)))
+            for (histogram_name, labels), values in sorted(histograms.items()):
+                if histogram_name != name:
+                    continue
+                for bound, count in zip(self.buckets, values):
+                    lines.append('{}_bucket{} {}'.format(name, format_labels(labels + (('le', repr(bound)),)), count))
+                lines.append('{}_bucket{} {}'.format(name, format_labels(labels + (('le', '+Inf'),)), values[-2]))
+                lines.append('{}_count{} {}'.format(name, format_labels(labels), values[-2]))
+                lines.append('{}_sum{} {}'.format(name, format_labels(labels), format_value(values[-1])))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = ['{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels]
+    return '{' + ','.join(escaped) + '}'
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+registry = MetricsRegistry()
+
+
+## Recording
+def record_auth_error(error, status_code):
+    code = error.get('code', 'unknown') if isinstance(error, dict) else 'unknown'
+    registry.inc('capstone_auth_errors_total', {'code': code, 'status': str(status_code)})
+
+def record_process_stats():
+    # Cache and pool numbers are read from the objects that keep them
+    for cache_name, stats in (('token', token_cache.stats()), ('response', response_cache.stats())):
+        registry.set('capstone_cache_hits_total', {'cache': cache_name}, stats['hits'])
+        registry.set('capstone_cache_misses_total', {'cache': cache_name}, stats['misses'])
+        registry.set('capstone_cache_evictions_total', {'cache': cache_name}, stats['evictions'])
+
+    worker = {'pid': str(os.getpid())}
+    for stat, value in pool_stats().items():
+        registry.set(POOL_METRICS[stat], worker, value)
+    replicas = replica_router.stats()
+    if replicas['replicas']:
+        registry.set('capstone_db_replicas_healthy', worker, replicas['healthy'])
+        registry.set('capstone_db_replica_ejections_total', worker, replicas['ejections'])
+
+def render_metrics():
+    record_process_stats()
+    return registry.render()
+
+
+def init_metrics(app):
+    @app.before_request
+    def start_metrics_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        started = g.get('metrics_started', None)
+        if started is None:
+            return response
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        registry.inc('capstone_http_requests_total',
+            {'method': request.method, 'route': route, 'status': str(response.status_code)})
+        registry.observe('capstone_http_request_duration_seconds',
+            {'method': request.method, 'route': route}, time.perf_counter() - started)
+        if registry.flush_due():
+            record_process_stats()
+            registry.flush()
+        return response
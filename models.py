@@ -1,45 +1,443 @@
 import os
-from sqlalchemy import Column
-from flask_sqlalchemy import SQLAlchemy
+import time
+import sqlite3
+import datetime
+import logging
+import threading
+from dateutil import parser as date_parser
+from flask import g, request, has_request_context
+from sqlalchemy import Column, Index, DDL, create_engine, event, exc, orm, null
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.functions import FunctionElement
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.types import TypeDecorator
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 
 database_path = os.environ['DATABASE_URL']
 if database_path.startswith("postgres://"):
   database_path = database_path.replace("postgres://", "postgresql://", 1)
 
-db = SQLAlchemy()
+# Optional comma separated read replicas of DATABASE_URL, GET requests
+# read from them in turn. Empty sends everything to DATABASE_URL
+replica_paths = [path.strip().replace("postgres://", "postgresql://", 1)
+  for path in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if path.strip()]
+# Seconds between two health checks of the replicas, a replica that fails
+# one is left out until it passes again
+REPLICA_CHECK_INTERVAL = float(os.environ.get('REPLICA_CHECK_INTERVAL', 5))
+
+# Connection pool settings, the defaults are SQLAlchemy's own.
+# Pre-ping replaces connections that died (e.g. when Postgres restarted)
+# before a request gets them, recycle closes connections older than that
+# many seconds (-1 never does)
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', -1))
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes')
+
+# Longest a statement may run (Postgres only) per class of request,
+# in milliseconds, 0 leaves it unlimited
+STATEMENT_TIMEOUTS = {
+    'read': int(os.environ.get('STATEMENT_TIMEOUT_READ_MS', 0)),
+    'write': int(os.environ.get('STATEMENT_TIMEOUT_WRITE_MS', 0)),
+    'bulk': int(os.environ.get('STATEMENT_TIMEOUT_BULK_MS', 0)),
+}
+
+'''
+RoutingSession
+Flask-SQLAlchemy's session, sending the reads of GET requests to a
+replica. A request picks one replica and reads everything from it, so
+its ETag and its rows come from the same point of replication. Once a
+request writes anything it stays on the primary, so it reads its own
+writes.
+'''
+class RoutingSession(SignallingSession):
+  def get_bind(self, mapper=None, clause=None):
+    if replica_router.engines and self._reads_from_replica(clause):
+      if 'replica' not in g:
+        g.replica = replica_router.pick()
+      if g.replica is not None:
+        return g.replica
+    return super().get_bind(mapper, clause)
+
+  def _reads_from_replica(self, clause):
+    if not has_request_context() or request.method not in ('GET', 'HEAD'):
+      return False
+    if g.get('read_primary', False):
+      return False
+    if self._flushing or getattr(clause, 'is_dml', False):
+      read_from_primary()
+      return False
+    return True
+
+'''
+read_from_primary()
+    keeps the rest of the current request on the primary database
+'''
+def read_from_primary():
+    if has_request_context():
+        g.read_primary = True
+
+class RoutingSQLAlchemy(SQLAlchemy):
+  def create_session(self, options):
+    return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+db = RoutingSQLAlchemy()
+
+# SQLite only enforces foreign keys (and their ON DELETE CASCADE) when asked to
+@event.listens_for(Engine, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+# The trigram indexes used by /search need pg_trgm
+event.listen(db.metadata, 'before_create',
+    DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'))
+
+'''
+TimedQueuePool
+The usual QueuePool, also keeping how long requests waited for a
+connection and how often they gave up waiting
+'''
+class TimedQueuePool(QueuePool):
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.waits = 0
+    self.wait_seconds = 0.0
+    self.max_wait_seconds = 0.0
+    self.timeouts = 0
+    self._stats_lock = threading.Lock()
+
+  def _do_get(self):
+    start = time.perf_counter()
+    timed_out = False
+    try:
+      return super()._do_get()
+    except exc.TimeoutError:
+      timed_out = True
+      raise
+    finally:
+      waited = time.perf_counter() - start
+      with self._stats_lock:
+        self.waits += 1
+        self.wait_seconds += waited
+        self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        if timed_out:
+          self.timeouts += 1
+
+'''
+engine_options(database_path)
+    the pool settings for the database, SQLite keeps its own pool
+'''
+def engine_options(database_path=database_path):
+    options = {
+        'pool_pre_ping': DB_POOL_PRE_PING,
+        'pool_recycle': DB_POOL_RECYCLE
+    }
+    if make_url(database_path).get_backend_name() != 'sqlite':
+        options.update({
+            'poolclass': TimedQueuePool,
+            'pool_size': DB_POOL_SIZE,
+            'max_overflow': DB_MAX_OVERFLOW,
+            'pool_timeout': DB_POOL_TIMEOUT
+        })
+    return options
+
+'''
+pool_stats()
+    what the connection pool of this process is doing right now
+'''
+def pool_stats():
+    pool = db.engine.pool
+    stats = {}
+    for name, method in (('size', 'size'), ('checked_out', 'checkedout'), ('overflow', 'overflow')):
+        if hasattr(pool, method):
+            stats[name] = getattr(pool, method)()
+    if isinstance(pool, TimedQueuePool):
+        stats.update({
+            'waits': pool.waits,
+            'wait_seconds': pool.wait_seconds,
+            'max_wait_seconds': pool.max_wait_seconds,
+            'timeouts': pool.timeouts
+        })
+    return stats
+
+'''
+set_request_class(name) / request_class()
+    the class of the current request ('read', 'write' or 'bulk') picks its
+    statement timeout. GET requests are reads and everything else writes,
+    unless the route says otherwise.
+'''
+def set_request_class(name):
+    g.request_class = name
+    # A transaction already running switches over to the new timeout too
+    session = db.session()
+    if session.in_transaction():
+        apply_statement_timeout(session, None, session.connection())
+
+def request_class():
+    if not has_request_context():
+        return None
+    name = g.get('request_class', None)
+    if name is None:
+        name = 'read' if request.method in ('GET', 'HEAD') else 'write'
+    return name
+
+# SET LOCAL only lasts for the transaction, so every transaction a
+# request begins gets it again
+@event.listens_for(Session, 'after_begin')
+def apply_statement_timeout(session, transaction, connection):
+    if connection.dialect.name != 'postgresql':
+        return
+    timeout = STATEMENT_TIMEOUTS.get(request_class(), 0)
+    if timeout > 0:
+        connection.exec_driver_sql('SET LOCAL statement_timeout = {:d}'.format(timeout))
+
+'''
+ReplicaRouter
+The read replica engines of this process. pick() hands them out round
+robin, skipping replicas that failed their last health check or lost
+their connection. Health checks run in the background every
+check_interval seconds and bring recovered replicas back.
+'''
+class ReplicaRouter:
+  def __init__(self, check_interval=REPLICA_CHECK_INTERVAL, clock=time.monotonic):
+    self.check_interval = check_interval
+    self.clock = clock
+    self.engines = []
+    self.healthy = []
+    self.ejections = 0
+    self._next = 0
+    self._checked_at = 0
+    self._checking = False
+    self._lock = threading.Lock()
+
+  def configure(self, paths):
+    for engine in self.engines:
+      engine.dispose()
+    engines = [create_engine(path, **engine_options(path)) for path in paths]
+    for engine in engines:
+      event.listen(engine, 'handle_error', self._handle_error)
+    with self._lock:
+      self.engines = engines
+      self.healthy = list(engines)
+      self._checked_at = self.clock()
+
+  def pick(self):
+    if self.clock() - self._checked_at >= self.check_interval:
+      self._check_in_background()
+    with self._lock:
+      if not self.healthy:
+        return None
+      engine = self.healthy[self._next % len(self.healthy)]
+      self._next += 1
+      return engine
+
+  def eject(self, engine):
+    with self._lock:
+      if engine in self.healthy:
+        self.healthy.remove(engine)
+        self.ejections += 1
+
+  def check(self):
+    passed = []
+    for engine in self.engines:
+      try:
+        with engine.connect() as connection:
+          connection.exec_driver_sql('SELECT 1')
+        passed.append(engine)
+      except Exception:
+        continue
+    with self._lock:
+      self.ejections += len([engine for engine in self.healthy if engine not in passed])
+      self.healthy = passed
+      self._checked_at = self.clock()
+
+  def stats(self):
+    return {'replicas': len(self.engines), 'healthy': len(self.healthy), 'ejections': self.ejections}
+
+  def _handle_error(self, context):
+    # A lost or refused connection takes the replica out right away
+    if context.is_disconnect or context.connection is None:
+      self.eject(context.engine)
+
+  def _check_in_background(self):
+    if self._checking:
+      return
+    self._checking = True
+
+    def run():
+      try:
+        self.check()
+      finally:
+        self._checking = False
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+replica_router = ReplicaRouter()
 
 '''
 setup_db(app)
     binds a flask application and a SQLAlchemy service
 '''
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=database_path, replica_paths=replica_paths):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_path)
+    replica_router.configure(replica_paths)
     db.app = app
     db.init_app(app)
     db.create_all()
+    seed_table_versions()
 
+'''
+supports_returning()
+    True when the database can send back rows from INSERT/UPDATE/DELETE
+'''
+def supports_returning():
+    return getattr(db.engine.dialect, 'full_returning', False)
+
+'''
+parse_release_date(value)
+    turns "2015-05-29" or older strings like "May 29th, 2015" into a date,
+    raises ValueError when it can't or when the year, month or day is missing
+'''
+def parse_release_date(value):
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    if not isinstance(value, str) or not value.strip():
+        raise ValueError('release_date must be a date string')
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        pass
+    try:
+        # dateutil fills missing parts from the default, parsing against two
+        # defaults that differ in every part shows whether one was missing
+        parsed = date_parser.parse(value, default=datetime.datetime(2000, 1, 1)).date()
+        if parsed != date_parser.parse(value, default=datetime.datetime(2001, 2, 2)).date():
+            raise ValueError('release_date {!r} needs a year, month and day'.format(value))
+        return parsed
+    except (ValueError, OverflowError):
+        raise ValueError('unable to parse release_date {!r}'.format(value))
+
+'''
+ReleaseDate
+    a Date column that also accepts date strings, so json values, cursors
+    and query parameters can be bound to it directly
+'''
+class ReleaseDate(TypeDecorator):
+  impl = db.Date
+  cache_ok = True
+
+  @property
+  def python_type(self):
+    return datetime.date
+
+  def process_bind_param(self, value, dialect):
+    if value is None:
+      return None
+    return parse_release_date(value)
+
+
+'''
+movie_cast
+Which actors are cast in which movies. Rows go away with their movie or actor.
+'''
+movie_cast = db.Table('movie_cast',
+  Column('movie_id', db.Integer, db.ForeignKey('movies.id', ondelete='CASCADE'), primary_key=True),
+  Column('actor_id', db.Integer, db.ForeignKey('actors.id', ondelete='CASCADE'), primary_key=True, index=True)
+)
+
+
+'''
+utc_now()
+    the current UTC time as a column default in the database, like the
+    datetime.utcnow the app writes. Postgres' now() is in the session's
+    time zone, SQLite's CURRENT_TIMESTAMP is already UTC
+'''
+class utc_now(FunctionElement):
+  type = db.DateTime()
+  inherit_cache = True
+
+@compiles(utc_now)
+def compile_utc_now(element, compiler, **kw):
+  return 'CURRENT_TIMESTAMP'
+
+@compiles(utc_now, 'postgresql')
+def compile_utc_now_postgresql(element, compiler, **kw):
+  return "TIMEZONE('utc', CURRENT_TIMESTAMP)"
+
+
+def format_date(value):
+  if isinstance(value, datetime.date):
+    return value.isoformat()
+  return value
 
 '''
 Movies
 '''
 class Movies(db.Model):  
   __tablename__ = 'movies'
+  # (column, id) indexes serve sorted keyset pages and release date ranges,
+  # the text_pattern_ops index serves title prefix filters (LIKE 'x%') and
+  # the trigram index serves /search on postgres
+  __table_args__ = (
+    Index('ix_movies_title_id', 'title', 'id'),
+    Index('ix_movies_title_pattern', 'title', postgresql_ops={'title': 'text_pattern_ops'}),
+    Index('ix_movies_release_date_id', 'release_date', 'id'),
+    Index('ix_movies_title_trgm', 'title', postgresql_using='gin', postgresql_ops={'title': 'gin_trgm_ops'}),
+    Index('ix_movies_change_seq_id', 'change_seq', 'id'),
+  )
 
   id = Column(db.Integer, primary_key=True)
   title = Column(db.String(120))
-  release_date = Column(db.String(120))
+  release_date = Column(ReleaseDate)
+  # Bumped on every edit, used for If-Match optimistic concurrency
+  version = Column(db.Integer, nullable=False, default=1, server_default='1')
+  # Set (in UTC) on every insert and edit
+  updated_at = Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow,
+    onupdate=datetime.datetime.utcnow, server_default=utc_now())
+  # Change sequence number of the commit that last inserted or edited the
+  # row, null until that commit stamps it. GET /movies/changes pages through it
+  change_seq = Column(db.BigInteger, default=None, onupdate=null())
+  actors = db.relationship('Actors', secondary=movie_cast, back_populates='movies', passive_deletes=True)
   
 
   def __init__(self, title, release_date):
     self.title = title
     self.release_date = release_date
 
+  # Returns a list of problems with a movie's json, empty when it is valid.
+  # partial only checks the fields that are present, for edits
+  @staticmethod
+  def validate(data, partial=False):
+    if not isinstance(data, dict):
+      return ['movie must be an object']
+    errors = []
+    if (not partial or 'title' in data) and (not isinstance(data.get('title'), str) or not data.get('title')):
+      errors.append('title must be a non empty string')
+    if data.get('release_date') is not None:
+      try:
+        parse_release_date(data['release_date'])
+      except ValueError:
+        errors.append('release_date must be a date, like 2015-05-29')
+    return errors
+
   def format(self):
     return {
       'id': self.id,
       "title": self.title,
-      'release_date': self.release_date
+      'release_date': format_date(self.release_date),
+      'version': self.version
     }
   
 '''
@@ -47,11 +445,31 @@ Actors
 '''
 class Actors(db.Model):  
   __tablename__ = 'actors'
+  # (column, id) indexes serve sorted keyset pages and age ranges, the
+  # text_pattern_ops index serves name prefix filters (LIKE 'x%') and the
+  # trigram index serves /search on postgres
+  __table_args__ = (
+    Index('ix_actors_gender_age', 'gender', 'age'),
+    Index('ix_actors_age_id', 'age', 'id'),
+    Index('ix_actors_name_id', 'name', 'id'),
+    Index('ix_actors_name_pattern', 'name', postgresql_ops={'name': 'text_pattern_ops'}),
+    Index('ix_actors_name_trgm', 'name', postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'}),
+    Index('ix_actors_change_seq_id', 'change_seq', 'id'),
+  )
 
   id = Column(db.Integer, primary_key=True)
   name = Column(db.String(120))
   age = Column(db.Integer)
   gender = Column(db.String(120))
+  # Bumped on every edit, used for If-Match optimistic concurrency
+  version = Column(db.Integer, nullable=False, default=1, server_default='1')
+  # Set (in UTC) on every insert and edit
+  updated_at = Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow,
+    onupdate=datetime.datetime.utcnow, server_default=utc_now())
+  # Change sequence number of the commit that last inserted or edited the
+  # row, null until that commit stamps it. GET /actors/changes pages through it
+  change_seq = Column(db.BigInteger, default=None, onupdate=null())
+  movies = db.relationship('Movies', secondary=movie_cast, back_populates='actors', passive_deletes=True)
   
 
   def __init__(self, name, age, gender):
@@ -59,10 +477,166 @@ class Actors(db.Model):
     self.age = age
     self.gender = gender
 
+  # Returns a list of problems with an actor's json, empty when it is valid.
+  # partial only checks the fields that are present, for edits
+  @staticmethod
+  def validate(data, partial=False):
+    if not isinstance(data, dict):
+      return ['actor must be an object']
+    errors = []
+    if (not partial or 'name' in data) and (not isinstance(data.get('name'), str) or not data.get('name')):
+      errors.append('name must be a non empty string')
+    age = data.get('age')
+    if age is not None and (not isinstance(age, int) or isinstance(age, bool) or age < 0):
+      errors.append('age must be a positive integer')
+    if data.get('gender') is not None and not isinstance(data.get('gender'), str):
+      errors.append('gender must be a string')
+    return errors
+
   def format(self):
     return {
       'id': self.id,
       'name': self.name,
       'age': self.age,
-      'gender': self.gender
+      'gender': self.gender,
+      'version': self.version
     }
+
+
+'''
+Tombstones
+One row per deleted actor or movie, so clients syncing through the
+/changes endpoints learn what to remove
+'''
+class Tombstones(db.Model):
+  __tablename__ = 'tombstones'
+  __table_args__ = (
+    Index('ix_tombstones_table_name_change_seq', 'table_name', 'change_seq', 'record_id'),
+  )
+
+  id = Column(db.Integer, primary_key=True)
+  table_name = Column(db.String(64), nullable=False)
+  record_id = Column(db.Integer, nullable=False)
+  deleted_at = Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+  # Change sequence number of the commit that deleted the row
+  change_seq = Column(db.BigInteger)
+
+# Called in the transaction that deleted the rows
+def record_tombstones(name, ids):
+  if ids:
+    db.session.execute(Tombstones.__table__.insert(),
+      [{'table_name': name, 'record_id': record_id} for record_id in ids])
+
+
+'''
+TableVersions
+A change counter per table, bumped right after every write is committed.
+Kept in the database so every worker process agrees on it. change_seq is
+the last change sequence number handed to a commit writing the table.
+'''
+class TableVersions(db.Model):
+  __tablename__ = 'table_versions'
+
+  name = Column(db.String(64), primary_key=True)
+  version = Column(db.Integer, nullable=False, default=0)
+  change_seq = Column(db.BigInteger, nullable=False, default=0, server_default='0')
+
+
+VERSIONED_TABLES = (Actors.__tablename__, Movies.__tablename__)
+SYNCED_TABLES = {Actors.__tablename__: Actors.__table__, Movies.__tablename__: Movies.__table__}
+
+def seed_table_versions():
+  existing = {row.name for row in TableVersions.query.all()}
+  for name in VERSIONED_TABLES:
+    if name not in existing:
+      db.session.add(TableVersions(name=name, version=0))
+  db.session.commit()
+
+# Times a table's change counter bump is tried after a commit
+TABLE_VERSION_BUMP_ATTEMPTS = int(os.environ.get('TABLE_VERSION_BUMP_ATTEMPTS', 3))
+table_versions_logger = logging.getLogger('capstone.table_versions')
+# Tables committed to whose counter could not be bumped. Their version is
+# not handed out again until the bump went through, so no ETag or cached
+# response of before the write can be taken for the current one
+stale_tables = set()
+stale_tables_lock = threading.Lock()
+
+# Called before the commit of anything that writes to the table. The
+# counter is only bumped once that commit went through, in a short
+# transaction of its own, so concurrent writers to a table don't queue on
+# its row lock for as long as their transactions run
+def bump_table_version(name):
+  db.session.info.setdefault('changed_tables', set()).add(name)
+
+# Returns whether the counters were bumped, retrying with a short backoff
+def bump_table_versions(names):
+  table = TableVersions.__table__
+  for attempt in range(1, TABLE_VERSION_BUMP_ATTEMPTS + 1):
+    try:
+      with db.engine.begin() as connection:
+        # Same order in every process, so two bumps can't deadlock
+        for name in sorted(names):
+          connection.execute(table.update().where(table.c.name == name).values(
+            version=table.c.version + 1))
+      return True
+    except Exception:
+      table_versions_logger.warning('bumping the versions of %s failed (attempt %d of %d)',
+        ', '.join(sorted(names)), attempt, TABLE_VERSION_BUMP_ATTEMPTS, exc_info=True)
+      if attempt < TABLE_VERSION_BUMP_ATTEMPTS:
+        time.sleep(0.01 * 2 ** attempt)
+  return False
+
+# Right before a commit, stamps the changed tables' rows and tombstones
+# that have no change sequence number yet with the table's next one. The
+# counter row stays locked until the commit, so the numbers are handed out
+# in commit order and a sync that saw number N can't miss a commit below
+# it. A row written without bump_table_version is stamped by the next
+# commit to its table
+@event.listens_for(Session, 'before_commit')
+def stamp_changes(session):
+  names = [name for name in sorted(session.info.get('changed_tables', ())) if name in SYNCED_TABLES]
+  if not names or session.in_nested_transaction():
+    return
+  session.flush()
+  counters = TableVersions.__table__
+  tombstones = Tombstones.__table__
+  for name in names:
+    bump = counters.update().where(counters.c.name == name).values(change_seq=counters.c.change_seq + 1)
+    if supports_returning():
+      change_seq = session.execute(bump.returning(counters.c.change_seq)).scalar()
+    else:
+      session.execute(bump)
+      change_seq = session.execute(counters.select().with_only_columns([counters.c.change_seq]).where(
+        counters.c.name == name)).scalar()
+    table = SYNCED_TABLES[name]
+    session.execute(table.update().where(table.c.change_seq.is_(None)).values(
+      change_seq=change_seq, updated_at=table.c.updated_at))
+    session.execute(tombstones.update().where(tombstones.c.table_name == name,
+      tombstones.c.change_seq.is_(None)).values(change_seq=change_seq))
+
+@event.listens_for(Session, 'after_commit')
+def bump_changed_tables(session):
+  names = session.info.pop('changed_tables', None)
+  if not names or bump_table_versions(names):
+    return
+  table_versions_logger.error('the versions of %s were not bumped after a commit, '
+    'reads of them fail until the bump goes through', ', '.join(sorted(names)))
+  with stale_tables_lock:
+    stale_tables.update(names)
+
+@event.listens_for(Session, 'after_transaction_end')
+def forget_changed_tables(session, transaction):
+  if transaction.parent is None:
+    session.info.pop('changed_tables', None)
+
+# Raises while the table's counter is stale and still can't be bumped
+def get_table_version(name):
+  if name in stale_tables:
+    with stale_tables_lock:
+      if name in stale_tables:
+        if not bump_table_versions({name}):
+          raise RuntimeError('the version of {} is stale'.format(name))
+        stale_tables.discard(name)
+  table = TableVersions.__table__
+  return db.session.execute(table.select().with_only_columns([table.c.version]).where(
+    table.c.name == name)).scalar() or 0
@@ -0,0 +1,152 @@
+import os
+import re
+import threading
+from sqlalchemy import select, literal, func, or_, union_all
+from models import db, get_table_version, Actors, Movies
+
+
+# Smallest similarity (0 to 1) for a fuzzy match, same default as pg_trgm
+SEARCH_SIMILARITY_THRESHOLD = float(os.environ.get('SEARCH_SIMILARITY_THRESHOLD', 0.3))
+# Largest number of results a search can skip, keeps deep pages cheap
+SEARCH_MAX_OFFSET = int(os.environ.get('SEARCH_MAX_OFFSET', 1000))
+
+# What can be searched: result type, model, searched column and the
+# permission needed to see it
+SEARCHABLE = (
+    ('movie', Movies, Movies.title, 'read:movies'),
+    ('actor', Actors, Actors.name, 'read:actors'),
+)
+
+
+## Trigrams
+def trigrams(text):
+    # Same trigrams pg_trgm makes: lower case words padded with
+    # two spaces in front and one behind
+    grams = set()
+    for word in re.findall(r'\w+', (text or '').lower()):
+        padded = '  ' + word + ' '
+        for start in range(len(padded) - 2):
+            grams.add(padded[start:start + 3])
+    return grams
+
+def similarity(first, second):
+    if not first or not second:
+        return 0.0
+    return len(first & second) / len(first | second)
+
+
+'''
+NgramIndex
+A pure Python trigram index over one text column, used when the
+database is not PostgreSQL (e.g. SQLite test databases). It is rebuilt
+from the table whenever the table's change counter moves.
+'''
+class NgramIndex:
+    def __init__(self, model, column):
+        self.model = model
+        self.column = column
+        self.version = None
+        self.postings = {}
+        self.texts = {}
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        version = get_table_version(self.model.__tablename__)
+        if version == self.version:
+            return
+        with self._lock:
+            if version == self.version:
+                return
+            postings = {}
+            texts = {}
+            rows = db.session.query(self.model.id, self.column).yield_per(1000)
+            for row_id, text in rows:
+                texts[row_id] = text or ''
+                for gram in trigrams(text):
+                    postings.setdefault(gram, set()).add(row_id)
+            self.postings = postings
+            self.texts = texts
+            self.version = version
+
+    # Returns (score, id) for every row that looks like the query
+    def search(self, query, threshold=SEARCH_SIMILARITY_THRESHOLD):
+        self.refresh()
+        query_grams = trigrams(query)
+        lowered = query.lower()
+        candidates = set()
+        for gram in query_grams:
+            candidates |= self.postings.get(gram, set())
+
+        matches = []
+        for row_id in candidates:
+            text = self.texts[row_id]
+            text_grams = trigrams(text)
+            score = max(similarity(query_grams, text_grams), word_similarity(query_grams, text))
+            if score >= threshold or lowered in text.lower():
+                matches.append((score, row_id))
+        return matches
+
+def word_similarity(query_grams, text):
+    # Best similarity between the query and any single word of the text
+    best = 0.0
+    for word in re.findall(r'\w+', text):
+        best = max(best, similarity(query_grams, trigrams(word)))
+    return best
+
+
+ngram_indexes = {kind: NgramIndex(model, column) for kind, model, column, permission in SEARCHABLE}
+
+
+## Searching
+def like_contains(query):
+    escaped = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return '%' + escaped + '%'
+
+def postgres_ranking(kinds, query, limit, offset):
+    # One ranked UNION ALL, every branch is served by a gin_trgm_ops index
+    selects = []
+    for kind, model, column, permission in SEARCHABLE:
+        if kind not in kinds:
+            continue
+        score = func.greatest(func.similarity(column, query), func.word_similarity(query, column))
+        selects.append(select(
+            literal(kind).label('kind'),
+            model.id.label('id'),
+            score.label('score')
+        ).where(or_(
+            column.op('%')(query),
+            literal(query).op('<%')(column),
+            column.ilike(like_contains(query), escape='\\')
+        )))
+    ranked = union_all(*selects).subquery()
+    statement = select(ranked.c.kind, ranked.c.id, ranked.c.score).order_by(
+        ranked.c.score.desc(), ranked.c.kind, ranked.c.id).limit(limit).offset(offset)
+    return [(row.kind, row.id, row.score) for row in db.session.execute(statement)]
+
+def ngram_ranking(kinds, query, limit, offset):
+    matches = []
+    for kind, model, column, permission in SEARCHABLE:
+        if kind in kinds:
+            matches.extend((kind, row_id, score) for score, row_id in ngram_indexes[kind].search(query))
+    matches.sort(key=lambda match: (-match[2], match[0], match[1]))
+    return matches[offset:offset + limit]
+
+def search(query, kinds, limit, offset=0):
+    # Returns ranked results as dicts, loading the rows of each type with one query
+    if db.engine.dialect.name == 'postgresql':
+        ranking = postgres_ranking(kinds, query, limit, offset)
+    else:
+        ranking = ngram_ranking(kinds, query, limit, offset)
+
+    records = {}
+    for kind, model, column, permission in SEARCHABLE:
+        ids = [row_id for result_kind, row_id, score in ranking if result_kind == kind]
+        if ids:
+            records[kind] = {record.id: record for record in model.query.filter(model.id.in_(ids))}
+
+    results = []
+    for kind, row_id, score in ranking:
+        record = records.get(kind, {}).get(row_id, None)
+        if record is not None:
+            results.append({"type": kind, "score": round(float(score), 4), kind: record.format()})
+    return results
@@ -1,9 +1,36 @@
 import os
 import unittest
+import io
+import runpy
 import json
+import sqlite3
+import socket
+import tempfile
+import threading
+import subprocess
+import sys
+import time
+import importlib.util
+import urllib.request
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from unittest import mock
+from sqlalchemy import event
 from flask_sqlalchemy import SQLAlchemy
-from app import create_app
-from models import setup_db
+from jose import jwt
+from app import create_app, changes_since, decode_since, encode_token, get_page_args, stream_limit, MAX_PAGE_SIZE
+from flask import Flask, g
+from sqlalchemy import exc
+from models import setup_db, db as app_db, engine_options, parse_release_date, request_class, TimedQueuePool, \
+    ReplicaRouter, replica_router, record_tombstones, bump_table_version, get_table_version, stale_tables, Actors
+from auth import JWKSKeyStore, TokenCache, set_jwks_fetcher, url_jwks_fetcher, AUTH0_DOMAIN, API_AUDIENCE, JWKS_URL
+from cache import MemoryCacheBackend
+from search import trigrams, similarity
+from instrumentation import redact, server_timing
+from metrics import MetricsRegistry
+from local_auth import LocalSigningKey
+from benchmark import compare, percentile
+from group_commit import GroupCommitter
+from data_transfer import export_table, import_table, copy_out, ImportRecordError
 from tokens import EXPIRED_TOKEN, CASTING_ASSISTANT_TOKEN, CASTING_DIRECTOR_TOKEN, EXECUTIVE_PRODUCER_TOKEN 
 
 class CapstoneTestCase(unittest.TestCase):
@@ -31,6 +58,20 @@ class CapstoneTestCase(unittest.TestCase):
         """Executed after reach test"""
         pass
 
+    # Runs a GET and returns the response with the number of SQL statements it ran
+    def get_counting_queries(self, url, headers):
+        statements = []
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        with self.app.app_context():
+            engine = app_db.engine
+        event.listen(engine, 'before_cursor_execute', count)
+        try:
+            res = self.client().get(url, headers=headers)
+        finally:
+            event.remove(engine, 'before_cursor_execute', count)
+        return res, len(statements)
+
     # ENDPOINT TESTING
 
     # Testing the root endpoint
@@ -96,6 +137,16 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertTrue(data['message'])
         self.assertTrue(data['error'])
 
+    # Test for Actor creation endpoint failure,
+    # Failed because the age is not a number
+    def test_create_actor_endpoint_bad_age(self):
+        res = self.client().post('/actors', headers={'Authorization':"Bearer {}".format(EXECUTIVE_PRODUCER_TOKEN)},
+            json={'name':'Dwayne "The Rock" Johnson', 'age':'x', 'gender': 'Male'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
     # Test for Movie creation endpoint
     def test_create_movie_endpoint(self):
         res = self.client().post('/movies', headers={'Authorization':"Bearer {}".format(EXECUTIVE_PRODUCER_TOKEN)},
@@ -118,6 +169,59 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertTrue(data['message'])
         self.assertTrue(data['error'])
 
+    # Test for Movie creation endpoint failure,
+    # Failed because the release date has no month or day
+    def test_create_movie_endpoint_partial_date(self):
+        res = self.client().post('/movies', headers={'Authorization':"Bearer {}".format(EXECUTIVE_PRODUCER_TOKEN)},
+            json={'title':'San Andreas', 'release_date':'2015'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+    # Test for bulk Actor creation endpoint
+    def test_bulk_create_actors_endpoint(self):
+        res = self.client().post('/actors/bulk', headers={'Authorization':"Bearer {}".format(EXECUTIVE_PRODUCER_TOKEN)},
+            json=[{'name':'Kevin Hart', 'age':43, 'gender': 'Male'}, {'name':'Emily Blunt', 'age':40, 'gender': 'Female'}])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['created'], 2)
+        self.assertTrue(data['results'][1]['actor']['id'])
+
+    # Test for bulk Actor creation endpoint failure,
+    # Failed because the second actor has no name, so nothing is created
+    def test_bulk_create_actors_endpoint_failure(self):
+        res = self.client().post('/actors/bulk', headers={'Authorization':"Bearer {}".format(EXECUTIVE_PRODUCER_TOKEN)},
+            json={'actors': [{'name':'Kevin Hart', 'age':43, 'gender': 'Male'}, {'age':40}]})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['results'][0]['valid'], True)
+        self.assertEqual(data['results'][1]['valid'], False)
+
+    # Test for bulk Movie creation endpoint
+    def test_bulk_create_movies_endpoint(self):
+        res = self.client().post('/movies/bulk', headers={'Authorization':"Bearer {}".format(EXECUTIVE_PRODUCER_TOKEN)},
+            json={'movies': [{'title':'Jumanji', 'release_date':'December 20th, 2017'}]})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(data['results'][0]['movie']['id'])
+
+    # Test for bulk Movie creation endpoint failure,
+    # Failed because casting directors cannot add movies
+    def test_bulk_create_movies_endpoint_failure(self):
+        res = self.client().post('/movies/bulk', headers={'Authorization':"Bearer {}".format(CASTING_DIRECTOR_TOKEN)},
+            json={'movies': [{'title':'Jumanji', 'release_date':'December 20th, 2017'}]})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(data['success'], False)
+
     # Test for Actor view endpoint
     def test_actor_view_endpoint(self):
         res = self.client().get('/actors', headers={'Authorization':"Bearer {}".format(EXECUTIVE_PRODUCER_TOKEN)})
@@ -158,6 +262,402 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertTrue(data['message'])
         self.assertTrue(data['error'])
 
+    # Test for paginated Actor view endpoint
+    def test_actor_view_pagination(self):
+        res = self.client().get('/actors?limit=1', headers={'Authorization':"Bearer {}".format(EXECUTIVE_PRODUCER_TOKEN)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(len(data['actors']), 1)
+        self.assertIn('next_cursor', data)
+
+    # Test for paginated Actor view endpoint failure,
+    # Failed because the cursor is not a valid cursor
+    def test_actor_view_pagination_bad_cursor(self):
+        res = self.client().get('/actors?cursor=notacursor', headers={'Authorization':"Bearer {}".format(EXECUTIVE_PRODUCER_TOKEN)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertTrue(data['message'])
+
+    # Test for sorted Movie view endpoint failure,
+    # Failed because the cursor's release date was tampered with
+    def test_movie_view_pagination_tampered_cursor(self):
+        cursor = encode_token({'id': 1, 's': 'release_date', 'k': 'garbage'})
+        res = self.client().get('/movies?sort=release_date&cursor={}'.format(cursor),
+            headers={'Authorization':"Bearer {}".format(EXECUTIVE_PRODUCER_TOKEN)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    # Test for streaming Actor view endpoint failure,
+    # Failed because the limit is not a number
+    def test_actor_view_stream_bad_limit(self):
+        res = self.client().get('/actors?stream=1&limit=abc', headers={'Authorization':"Bearer {}".format(EXECUTIVE_PRODUCER_TOKEN)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    # Test for following the next_cursor of the Movie view endpoint
+    def test_movie_view_pagination_next_cursor(self):
+        headers = {'Authorization':"Bearer {}".format(EXECUTIVE_PRODUCER_TOKEN)}
+        for title in ('Jumanji', 'Rampage'):
+            self.client().post('/movies', headers=headers, json={'title':title, 'release_date':'2017-12-20'})
+        first = json.loads(self.client().get('/movies?limit=1', headers=headers).data)
+        res = self.client().get('/movies?limit=1&cursor={}'.format(first['next_cursor']), headers=headers)
+        data = json.loads(res.data)
+
+        self.assertIsNotNone(first['next_cursor'])
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['movies']), 1)
+        self.assertGreater(data['movies'][0]['id'], first['movies'][0]['id'])
+
+    # Test for streaming the Actor view endpoint as NDJSON
+    def test_actor_view_stream(self):
+        res = self.client().get('/actors', headers={'Authorization':"Bearer {}".format(EXECUTIVE_PRODUCER_TOKEN),
+            'Accept': 'application/x-ndjson'})
+        actors = [json.loads(line) for line in res.data.splitlines()]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertTrue(actors)
+        self.assertTrue(actors[0]['id'])
+
+    # Test for streaming the Movie view endpoint with ?stream=1
+    def test_movie_view_stream(self):
+        res = self.client().get('/movies?stream=1', headers={'Authorization':"Bearer {}".format(EXECUTIVE_PRODUCER_TOKEN)})
+        movies = [json.loads(line) for line in res.data.splitlines()]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertTrue(movies)
+
+    # Test for conditional GET on the Actor view endpoint
+    def test_actor_view_not_modified(self):
+        headers = {'Authorization':"Bearer {}".format(EXECUTIVE_PRODUCER_TOKEN)}
+        etag = self.client().get('/actors', headers=headers).headers['ETag']
+        headers['If-None-Match'] = etag
+        res = self.client().get('/actors', headers=headers)
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers['ETag'], etag)
+
+    # Test that editing a Movie changes the ETag of the single Movie view endpoint
+    def test_movie_view_etag_changes_on_write(self):
+        headers = {'Authorization':"Bearer {}".format(EXECUTIVE_PRODUCER_TOKEN)}
+        etag = self.client().get('/movies/1', headers=headers).headers['ETag']
+        self.client().patch('/movies', headers=headers, json={'id':1, 'title':'Rampage'})
+        headers['If-None-Match'] = etag
+        res = self.client().get('/movies/1', headers=headers)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    # Test that the ETag of the single Actor view endpoint works as If-Match for an edit
+    def test_actor_view_etag_as_if_match(self):
+        headers = {'Authorization':"Bearer {}".format(EXECUTIVE_PRODUCER_TOKEN)}
+        headers['If-Match'] = self.client().get('/actors/1', headers=headers).headers['ETag']
+        res = self.client().patch('/actors', headers=headers, json={'id':1, 'age':52})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['actor']['age'], 52)
+
+    # Test for editing Actor endpoint failure,
+    # Failed because the If-Match ETag belongs to another actor
+    def test_actor_view_etag_of_other_row_as_if_match(self):
+        headers = {'Authorization':"Bearer {}".format(EXECUTIVE_PRODUCER_TOKEN)}
+        headers['If-Match'] = self.client().get('/actors/1', headers=headers).headers['ETag']
+        res = self.client().patch('/actors', headers=headers, json={'id':2, 'age':52})
+
+        self.assertEqual(res.status_code, 412)
+        self.assertEqual(json.loads(res.data)['success'], False)
+
+    # Test for only asking for some fields from the Actor view endpoint
+    def test_actor_view_fields(self):
+        res = self.client().get('/actors?fields=name', headers={'Authorization':"Bearer {}".format(EXECUTIVE_PRODUCER_TOKEN)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(set(data['actors'][0].keys()), {'id', 'name'})
+
+    # Test for the fields of the Movie view endpoint failure,
+    # Failed because movies have no rating column
+    def test_movie_view_fields_unknown(self):
+        res = self.client().get('/movies?fields=title,rating', headers={'Authorization':"Bearer {}".format(EXECUTIVE_PRODUCER_TOKEN)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    # Test for filtering the Actor view endpoint
+    def test_actor_view_filters(self):
+        res = self.client().get('/actors?gender=Male&age_min=40&age_max=60', headers={'Authorization':"Bearer {}".format(EXECUTIVE_PRODUCER_TOKEN)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        for actor in data['actors']:
+            self.assertEqual(actor['gender'], 'Male')
+            self.assertTrue(40 <= actor['age'] <= 60)
+
+    # Test for filtering the Actor view endpoint failure,
+    # Failed because age_min is not a number
+    def test_actor_view_filters_bad_age(self):
+        res = self.client().get('/actors?age_min=old', headers={'Authorization':"Bearer {}".format(EXECUTIVE_PRODUCER_TOKEN)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    # Test for sorting the Movie view endpoint by title, one page at a time
+    def test_movie_view_sort(self):
+        headers = {'Authorization':"Bearer {}".format(EXECUTIVE_PRODUCER_TOKEN)}
+        titles = []
+        url = '/movies?sort=-title&limit=1'
+        while url:
+            data = json.loads(self.client().get(url, headers=headers).data)
+            titles.extend(movie['title'] for movie in data['movies'])
+            url = '/movies?sort=-title&limit=1&cursor={}'.format(data['next_cursor']) if data['next_cursor'] else None
+
+        self.assertEqual(titles, sorted(titles, reverse=True))
+
+    # Test for sorting the Movie view endpoint failure,
+    # Failed because movies have no rating column
+    def test_movie_view_sort_unknown(self):
+        res = self.client().get('/movies?sort=rating', headers={'Authorization':"Bearer {}".format(EXECUTIVE_PRODUCER_TOKEN)})
+
+        self.assertEqual(res.status_code, 400)
+
+    # Test for filtering the Movie view endpoint by release date
+    def test_movie_view_release_date_range(self):
+        res = self.client().get('/movies?released_after=2010-01-01&released_before=2016-12-31&sort=release_date',
+            headers={'Authorization':"Bearer {}".format(EXECUTIVE_PRODUCER_TOKEN)})
+        data = json.loads(res.data)
+        dates = [movie['release_date'] for movie in data['movies']]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(dates, sorted(dates))
+        for release_date in dates:
+            self.assertTrue('2010-01-01' <= release_date <= '2016-12-31')
+
+    # Test for Movie creation endpoint failure,
+    # Failed because the release date is not a date
+    def test_create_movie_bad_release_date(self):
+        res = self.client().post('/movies', headers={'Authorization':"Bearer {}".format(EXECUTIVE_PRODUCER_TOKEN)},
+            json={'title':'San Andreas', 'release_date':'sometime soon'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+    # Test for casting actors in movies
+    def test_assign_cast_endpoint(self):
+        headers = {'Authorization':"Bearer {}".format(CASTING_DIRECTOR_TOKEN)}
+        self.client().delete('/cast', headers=headers, json=[{'movie_id':1, 'actor_id':1}])
+        res = self.client().post('/cast', headers=headers,
+            json=[{'movie_id':1, 'actor_id':1}, {'movie_id':1, 'actor_id':1}])
+        data = json.loads(res.data)
+        again = json.loads(self.client().post('/cast', headers=headers, json=[{'movie_id':1, 'actor_id':1}]).data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['assigned'], 1)
+        self.assertEqual(again['assigned'], 0)
+
+    # Test for casting actors in movies failure,
+    # Failed because the actor does not exist
+    def test_assign_cast_endpoint_missing_actor(self):
+        res = self.client().post('/cast', headers={'Authorization':"Bearer {}".format(CASTING_DIRECTOR_TOKEN)},
+            json=[{'movie_id':1, 'actor_id':1}, {'movie_id':1, 'actor_id':999999}])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['results'], [{'movie_id':1, 'actor_id':999999, 'errors':['actor 999999 does not exist']}])
+
+    # Test for casting actors in movies failure,
+    # Failed because casting assistants cannot edit movies
+    def test_assign_cast_endpoint_failure(self):
+        res = self.client().post('/cast', headers={'Authorization':"Bearer {}".format(CASTING_ASSISTANT_TOKEN)},
+            json=[{'movie_id':1, 'actor_id':1}])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(data['success'], False)
+
+    # Test that including the cast of movies costs the same number of queries
+    # for one movie as for many
+    def test_movie_view_include_cast_queries(self):
+        headers = {'Authorization':"Bearer {}".format(EXECUTIVE_PRODUCER_TOKEN)}
+        self.client().post('/cast', headers=headers, json=[{'movie_id':1, 'actor_id':1}])
+        one, one_count = self.get_counting_queries('/movies?include=cast&limit=1', headers)
+        many, many_count = self.get_counting_queries('/movies?include=cast&limit=50', headers)
+        data = json.loads(one.data)
+
+        self.assertEqual(one.status_code, 200)
+        self.assertIn('cast', data['movies'][0])
+        self.assertEqual(one_count, many_count)
+        self.assertLessEqual(many_count, 4)
+
+    # Test that including the movies of actors does not run a query per actor
+    def test_actor_view_include_movies_queries(self):
+        headers = {'Authorization':"Bearer {}".format(EXECUTIVE_PRODUCER_TOKEN)}
+        res, count = self.get_counting_queries('/actors?include=movies&limit=50', headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('movies', data['actors'][0])
+        self.assertLessEqual(count, 4)
+
+    # Test for looking up many actors by id in one query, in the order asked for
+    def test_actor_view_ids(self):
+        headers = {'Authorization':"Bearer {}".format(CASTING_ASSISTANT_TOKEN)}
+        res, count = self.get_counting_queries('/actors?ids=2,999999,1', headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual([actor['id'] if actor else None for actor in data['actors']], [2, None, 1])
+        self.assertEqual(data['missing'], [999999])
+        self.assertLessEqual(count, 2)
+
+    # Test for looking up movies by id failure
+    # Failed because there are more ids than MAX_LOOKUP_IDS
+    def test_movie_view_ids_failure(self):
+        ids = ','.join(str(movie_id) for movie_id in range(1, 1002))
+        res = self.client().get('/movies?ids=' + ids, headers={'Authorization':"Bearer {}".format(CASTING_ASSISTANT_TOKEN)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 413)
+        self.assertEqual(data['success'], False)
+
+    # Test for looking up actors by id failure
+    # Failed because filters and pages don't apply to a lookup
+    def test_actor_view_ids_with_page_args(self):
+        headers = {'Authorization':"Bearer {}".format(CASTING_ASSISTANT_TOKEN)}
+        for query in ('gender=Male', 'sort=-age', 'limit=1', 'stream=1'):
+            res = self.client().get('/actors?ids=1,2&' + query, headers=headers)
+
+            self.assertEqual(res.status_code, 400)
+            self.assertEqual(json.loads(res.data)['success'], False)
+        self.assertEqual(self.client().get('/actors?ids=1,2&fields=name', headers=headers).status_code, 200)
+
+    # Test for syncing actors from the start
+    def test_actor_changes(self):
+        headers = {'Authorization':"Bearer {}".format(EXECUTIVE_PRODUCER_TOKEN)}
+        create = lambda name: json.loads(self.client().post('/actors', headers=headers,
+            json={'name':name, 'age':30, 'gender':'Female'}).data)['actor']['id']
+        edited, deleted = create('Edited Actor'), create('Deleted Actor')
+        page = {'next_since': None, 'has_more': True}
+        while page['has_more']:
+            since = page['next_since']
+            url = '/actors/changes?limit=100' + ('&since={}'.format(since) if since else '')
+            page = json.loads(self.client().get(url, headers=headers).data)
+        since = page['next_since']
+
+        created = create('Created Actor')
+        self.client().patch('/actors', headers=headers, json={'id':edited, 'age':31})
+        self.client().delete('/actors', headers=headers, json={'id':deleted})
+        res = self.client().get('/actors/changes?since={}'.format(since), headers=headers)
+        data = json.loads(res.data)
+        again = json.loads(self.client().get('/actors/changes?since={}'.format(data['next_since']), headers=headers).data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(sorted((change['id'], change['deleted']) for change in data['changes']),
+            [(edited, False), (deleted, True), (created, False)])
+        self.assertEqual([change['actor']['age'] for change in data['changes'] if change['id'] == edited], [31])
+        self.assertNotEqual(data['next_since'], since)
+        self.assertEqual(again['changes'], [])
+        self.assertEqual(again['next_since'], data['next_since'])
+
+    # Test for syncing movies
+    # Failed because the since token is malformed
+    def test_movie_changes_bad_token(self):
+        res = self.client().get('/movies/changes?since=not-a-token', headers={'Authorization':"Bearer {}".format(CASTING_ASSISTANT_TOKEN)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    # Test for running a create and an edit in one batch
+    def test_batch_endpoint(self):
+        res = self.client().post('/batch', headers={'Authorization':"Bearer {}".format(EXECUTIVE_PRODUCER_TOKEN)},
+            json={'operations': [
+                {'action':'create', 'type':'movie', 'title':'Batch Movie', 'release_date':'2024-02-02'},
+                {'action':'edit', 'type':'actor', 'id':1, 'age':51}
+            ]})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['results'][0]['movie']['title'], 'Batch Movie')
+        self.assertEqual(data['results'][1]['actor']['age'], 51)
+
+    # Test for batch failure, nothing is applied
+    # Failed because the actor to edit does not exist
+    def test_batch_endpoint_rolled_back(self):
+        headers = {'Authorization':"Bearer {}".format(EXECUTIVE_PRODUCER_TOKEN)}
+        res = self.client().post('/batch', headers=headers, json=[
+            {'action':'create', 'type':'actor', 'name':'Rolled Back Actor', 'age':30, 'gender':'Male'},
+            {'action':'edit', 'type':'actor', 'id':999999, 'age':40}
+        ])
+        data = json.loads(res.data)
+        lookup = json.loads(self.client().get('/actors?name=Rolled Back', headers=headers).data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['failed_index'], 1)
+        self.assertEqual(lookup['actors'], [])
+
+    # Test for batch failure
+    # Failed because casting assistants cannot create movies
+    def test_batch_endpoint_not_allowed(self):
+        res = self.client().post('/batch', headers={'Authorization':"Bearer {}".format(CASTING_ASSISTANT_TOKEN)},
+            json=[{'action':'create', 'type':'movie', 'title':'Not Allowed', 'release_date':'2024-02-02'}])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(data['success'], False)
+
+    # Test for the search endpoint with a misspelled name
+    def test_search_endpoint(self):
+        headers = {'Authorization':"Bearer {}".format(EXECUTIVE_PRODUCER_TOKEN)}
+        self.client().post('/actors', headers=headers, json={'name':'Adam Sandler', 'age':56, 'gender': 'Male'})
+        res = self.client().get('/search?q=Adam Sandlre', headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['results'][0]['type'], 'actor')
+        self.assertEqual(data['results'][0]['actor']['name'], 'Adam Sandler')
+
+    # Test for the search endpoint failure,
+    # Failed because no search text is given
+    def test_search_endpoint_failure(self):
+        res = self.client().get('/search', headers={'Authorization':"Bearer {}".format(EXECUTIVE_PRODUCER_TOKEN)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    # Test for the search endpoint with a token that can only read actors
+    def test_search_endpoint_actors_only(self):
+        key = LocalSigningKey()
+        set_jwks_fetcher(lambda: (key.jwks(), None))
+        try:
+            token = key.mint(AUTH0_DOMAIN, API_AUDIENCE, ['read:actors'])
+            res = self.client().get('/search?q=Adam Sandler', headers={'Authorization':"Bearer {}".format(token)})
+        finally:
+            set_jwks_fetcher(url_jwks_fetcher(JWKS_URL))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(all(result['type'] == 'actor' for result in data['results']))
+
     # Test for editing Actor endpoint
     def test_a_edit_actor_endpoint(self):
         res = self.client().patch('/actors', headers={'Authorization':"Bearer {}".format(EXECUTIVE_PRODUCER_TOKEN)},
@@ -180,6 +680,32 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertTrue(data['message'])
         self.assertTrue(data['error'])
 
+    # Test for editing only some of an Actor's fields
+    def test_a_partial_edit_actor_endpoint(self):
+        headers = {'Authorization':"Bearer {}".format(EXECUTIVE_PRODUCER_TOKEN)}
+        before = json.loads(self.client().get('/actors/1', headers=headers).data)['actor']
+        res = self.client().patch('/actors', headers=headers, json={'id':1, 'age':51})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actor']['age'], 51)
+        self.assertEqual(data['actor']['name'], before['name'])
+        self.assertEqual(data['actor']['version'], before['version'] + 1)
+        self.assertEqual(res.headers['ETag'], '"actors/1-v{}"'.format(before['version'] + 1))
+
+    # Test for editing Actor endpoint failure,
+    # Failed because the If-Match version is out of date
+    def test_a_edit_actor_endpoint_stale_version(self):
+        headers = {'Authorization':"Bearer {}".format(EXECUTIVE_PRODUCER_TOKEN)}
+        actor = json.loads(self.client().get('/actors/1', headers=headers).data)['actor']
+        headers['If-Match'] = '"{}"'.format(actor['version'] - 1)
+        res = self.client().patch('/actors', headers=headers, json={'id':1, 'age':52})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 412)
+        self.assertEqual(data['success'], False)
+        self.assertTrue(data['message'])
+
     # Test for editing Movie endpoint
     def test_a_edit_movie_endpoint(self):
         res = self.client().patch('/movies', headers={'Authorization':"Bearer {}".format(EXECUTIVE_PRODUCER_TOKEN)},
@@ -326,6 +852,42 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertTrue(data['message'])
         self.assertTrue(data['error'])
 
+    # Test for deleting a list of actors, ids that don't exist are reported as missing
+    def test_delete_actor_ids_endpoint(self):
+        res = self.client().post('/actors/bulk', headers={'Authorization':"Bearer {}".format(EXECUTIVE_PRODUCER_TOKEN)},
+            json=[{'name':'Delete Me', 'age':30, 'gender': 'Male'}, {'name':'Delete Me Too', 'age':31, 'gender': 'Female'}])
+        actor_ids = [result['actor']['id'] for result in json.loads(res.data)['results']]
+        res = self.client().delete('/actors/delete', headers={'Authorization':"Bearer {}".format(EXECUTIVE_PRODUCER_TOKEN)},
+            json={'ids': actor_ids + [999999]})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['deleted'], actor_ids)
+        self.assertEqual(data['missing'], [999999])
+
+    # Test for deleting movies by ?ids= failure
+    # Failed because none of the ids exist
+    def test_delete_movie_ids_endpoint_failure(self):
+        res = self.client().delete('/movies?ids=999998,999999', headers={'Authorization':"Bearer {}".format(EXECUTIVE_PRODUCER_TOKEN)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
+    # METRICS TESTING
+
+    # Test for the metrics endpoint, including auth error codes
+    def test_metrics_endpoint(self):
+        self.client().get('/actors')
+        res = self.client().get('/metrics')
+        text = res.data.decode('utf-8')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('capstone_http_requests_total{method="GET",route="/actors",status="401"}', text)
+        self.assertIn('capstone_auth_errors_total{code="authorization_header_missing",status="401"}', text)
+        self.assertIn('capstone_http_request_duration_seconds_bucket', text)
+
     # ERROR TESTING
 
     # Error tests
@@ -362,6 +924,722 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertTrue(data['message'])
 
 
+# PAGE ARGUMENT TESTING
+
+class PageArgsTestCase(unittest.TestCase):
+
+    def get_page_args(self, url):
+        with Flask(__name__).test_request_context(url):
+            return get_page_args(Actors)
+
+    # Test that leaving out the limit still returns a bounded page
+    def test_default_limit_is_bounded(self):
+        self.assertEqual(self.get_page_args('/actors'), (MAX_PAGE_SIZE, None))
+
+    # Test that a limit over MAX_PAGE_SIZE is capped
+    def test_limit_capped(self):
+        self.assertEqual(self.get_page_args('/actors?limit={}'.format(MAX_PAGE_SIZE + 1)), (MAX_PAGE_SIZE, None))
+
+    # Test that a stream reads every row only when no limit was given
+    def test_stream_limit(self):
+        with Flask(__name__).test_request_context('/actors?stream=1'):
+            self.assertIsNone(stream_limit(get_page_args(Actors)[0]))
+        with Flask(__name__).test_request_context('/actors?stream=1&limit=500'):
+            self.assertEqual(stream_limit(get_page_args(Actors)[0]), MAX_PAGE_SIZE)
+
+
+# RELEASE DATE TESTING
+
+class ReleaseDateTestCase(unittest.TestCase):
+
+    # Test that full dates parse in the formats the app has stored
+    def test_full_dates_parse(self):
+        self.assertEqual(str(parse_release_date('2015-05-29')), '2015-05-29')
+        self.assertEqual(str(parse_release_date('May 29th, 2015')), '2015-05-29')
+
+    # Test that dates missing a year, month or day are not filled in from today
+    def test_partial_dates_rejected(self):
+        for value in ('2015', 'May', '12', 'May 2015'):
+            with self.assertRaises(ValueError):
+                parse_release_date(value)
+
+
+# JWKS KEY STORE TESTING
+# These tests use a stub fetcher and a fake clock so no Auth0 tenant is needed
+
+def make_test_jwks(kid):
+    return LocalSigningKey(kid, bits=1024).jwks()
+
+class JWKSKeyStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.calls = 0
+        self.jwks = make_test_jwks('key-1')
+        self.max_age = None
+
+        def fetcher():
+            self.calls += 1
+            return self.jwks, self.max_age
+
+        self.store = JWKSKeyStore(fetcher, ttl=600, min_refresh_interval=30,
+            clock=lambda: self.now)
+
+    # Test that the key set is fetched once and reused
+    def test_jwks_cached_between_requests(self):
+        first_key = self.store.get_key('key-1')
+        self.now = 100
+        second_key = self.store.get_key('key-1')
+
+        self.assertTrue(first_key)
+        self.assertIs(first_key, second_key)
+        self.assertEqual(self.calls, 1)
+
+    # Test that the Cache-Control max-age is used over the default ttl
+    def test_jwks_respects_max_age(self):
+        self.max_age = 60
+        self.store.get_key('key-1')
+        self.now = 61
+        self.store.get_key('key-1')
+
+        self.assertEqual(self.calls, 2)
+
+    # Test that unknown kids refetch, but no more than once per interval
+    def test_jwks_unknown_kid_refetch_rate_limited(self):
+        self.store.get_key('key-1')
+        self.now = 31
+        self.assertIsNone(self.store.get_key('bogus-1'))
+        self.assertIsNone(self.store.get_key('bogus-2'))
+        self.assertIsNone(self.store.get_key('bogus-3'))
+
+        self.assertEqual(self.calls, 2)
+
+    # Test that a rotated key is picked up through an unknown kid
+    def test_jwks_rotated_key_found(self):
+        self.store.get_key('key-1')
+        self.jwks = make_test_jwks('key-2')
+        self.now = 31
+
+        self.assertTrue(self.store.get_key('key-2'))
+        self.assertIsNone(self.store.get_key('key-1'))
+
+    # Test that a failed first fetch keeps failing until the next fetch is allowed
+    def test_jwks_failed_first_fetch_raises(self):
+        def failing_fetcher():
+            self.calls += 1
+            raise OSError('jwks down')
+        self.store.fetcher = failing_fetcher
+
+        with self.assertRaises(OSError):
+            self.store.get_key('key-1')
+        self.now = 10
+        with self.assertRaises(LookupError):
+            self.store.get_key('key-1')
+        self.assertEqual(self.calls, 1)
+
+
+# TOKEN CACHE TESTING
+
+class TokenCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000
+        self.store = JWKSKeyStore(lambda: ({'keys': []}, None))
+        self.cache = TokenCache(self.store, maxsize=2, max_ttl=300,
+            clock=lambda: self.now)
+
+    # Test that a cached payload is returned until the token expires
+    def test_token_cache_hit_until_exp(self):
+        self.cache.put('token-1', {'exp': 1100, 'permissions': []})
+
+        self.assertTrue(self.cache.get('token-1'))
+        self.now = 1100
+        self.assertIsNone(self.cache.get('token-1'))
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    # Test that max_ttl caps long lived tokens
+    def test_token_cache_max_ttl(self):
+        self.cache.put('token-1', {'exp': 99999, 'permissions': []})
+        self.now = 1300
+
+        self.assertIsNone(self.cache.get('token-1'))
+
+    # Test that the least recently used token is evicted
+    def test_token_cache_eviction(self):
+        self.cache.put('token-1', {'exp': 2000})
+        self.cache.put('token-2', {'exp': 2000})
+        self.cache.get('token-1')
+        self.cache.put('token-3', {'exp': 2000})
+
+        self.assertTrue(self.cache.get('token-1'))
+        self.assertIsNone(self.cache.get('token-2'))
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    # Test that a JWKS rotation drops every cached token
+    def test_token_cache_cleared_on_rotation(self):
+        self.cache.put('token-1', {'exp': 2000})
+        self.store.clear()
+
+        self.assertIsNone(self.cache.get('token-1'))
+
+
+# RESPONSE CACHE TESTING
+
+class MemoryCacheBackendTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.backend = MemoryCacheBackend(maxsize=2, max_bytes=10, clock=lambda: self.now)
+
+    # Test that invalidating a tag only drops that tag's entries
+    def test_cache_invalidate_tag(self):
+        self.backend.set('a', b'1', 1, 'actors')
+        self.backend.set('m', b'2', 1, 'movies')
+        self.backend.invalidate('actors')
+
+        self.assertIsNone(self.backend.get('a'))
+        self.assertEqual(self.backend.get('m'), b'2')
+
+    # Test that the byte limit evicts the least recently used entry
+    def test_cache_byte_limit(self):
+        self.backend.set('a', b'123456', 6, 'actors')
+        self.backend.set('b', b'123456', 6, 'actors')
+
+        self.assertIsNone(self.backend.get('a'))
+        self.assertEqual(self.backend.stats()['evictions'], 1)
+        self.assertEqual(self.backend.stats()['bytes'], 6)
+
+    # Test that entries expire after their ttl
+    def test_cache_ttl(self):
+        self.backend.set('a', b'1', 1, 'actors', ttl=5)
+        self.now = 5
+
+        self.assertIsNone(self.backend.get('a'))
+
+
+# SEARCH TESTING
+
+class TrigramTestCase(unittest.TestCase):
+
+    # Test that trigrams match the ones pg_trgm makes
+    def test_trigrams(self):
+        self.assertEqual(trigrams('Cat'), {'  c', ' ca', 'cat', 'at '})
+
+    # Test that a misspelling is still similar, and other words are not
+    def test_similarity(self):
+        self.assertGreater(similarity(trigrams('Sandler'), trigrams('Sandlre')), 0.3)
+        self.assertLess(similarity(trigrams('Sandler'), trigrams('Barrymore')), 0.3)
+
+
+# INSTRUMENTATION TESTING
+
+class InstrumentationTestCase(unittest.TestCase):
+
+    # Test that slow query parameters never show their values
+    def test_redact_parameters(self):
+        self.assertEqual(redact({'name': 'Drew Barrymore', 'age': 48}), {'name': 'str', 'age': 'int'})
+        self.assertEqual(redact([('Drew', 48)]), [['str', 'int']])
+
+    # Test the Server-Timing header has the auth, db and serialize phases
+    def test_server_timing_header(self):
+        header = server_timing({'auth': 0.001, 'db': 0.002, 'serialize': 0.0005, 'queries': 3}, 0.004)
+
+        self.assertEqual(header, 'auth;dur=1.00, db;dur=2.00;desc="3 queries", serialize;dur=0.50, total;dur=4.00')
+
+
+class MetricsRegistryTestCase(unittest.TestCase):
+
+    # Test that histograms are rendered with cumulative buckets
+    def test_histogram_render(self):
+        registry = MetricsRegistry(shard_dir=None, buckets=(0.1, 1.0))
+        registry.observe('latency', {'route': '/'}, 0.05)
+        registry.observe('latency', {'route': '/'}, 0.5)
+        text = registry.render()
+
+        self.assertIn('latency_bucket{route="/",le="0.1"} 1', text)
+        self.assertIn('latency_bucket{route="/",le="1.0"} 2', text)
+        self.assertIn('latency_bucket{route="/",le="+Inf"} 2', text)
+        self.assertIn('latency_count{route="/"} 2', text)
+
+    # Test that the shards of two worker processes are added up on scrape
+    def test_shards_added_up(self):
+        with tempfile.TemporaryDirectory() as shard_dir:
+            other_worker = MetricsRegistry(shard_dir=shard_dir)
+            other_worker.inc('requests', {'status': '200'}, 3)
+            other_worker.flush()
+            os.rename(os.path.join(shard_dir, 'metrics-{}.json'.format(os.getpid())),
+                os.path.join(shard_dir, 'metrics-0.json'))
+            this_worker = MetricsRegistry(shard_dir=shard_dir)
+            this_worker.inc('requests', {'status': '200'}, 2)
+
+            self.assertIn('requests{status="200"} 5', this_worker.render())
+
+
+# CONNECTION POOL TESTING
+
+class ConnectionPoolTestCase(unittest.TestCase):
+
+    # Test that the pool settings only go to databases with a queue pool
+    def test_engine_options(self):
+        sqlite_options = engine_options('sqlite:///capstone.db')
+        postgres_options = engine_options('postgresql://localhost/capstone')
+
+        self.assertIn('pool_pre_ping', sqlite_options)
+        self.assertNotIn('pool_size', sqlite_options)
+        self.assertIs(postgres_options['poolclass'], TimedQueuePool)
+        self.assertIn('pool_size', postgres_options)
+        self.assertIn('pool_timeout', postgres_options)
+
+    # Test that waits and timeouts for a connection are counted
+    def test_pool_wait_stats(self):
+        pool = TimedQueuePool(lambda: sqlite3.connect(':memory:'), pool_size=1, max_overflow=0, timeout=0.05)
+        connection = pool.connect()
+
+        with self.assertRaises(exc.TimeoutError):
+            pool.connect()
+        connection.close()
+
+        self.assertEqual(pool.waits, 2)
+        self.assertEqual(pool.timeouts, 1)
+        self.assertGreaterEqual(pool.max_wait_seconds, 0.05)
+
+    # Test that requests are classed by method unless the route says otherwise
+    def test_request_class(self):
+        flask_app = Flask(__name__)
+
+        self.assertIsNone(request_class())
+        with flask_app.test_request_context('/actors', method='GET'):
+            self.assertEqual(request_class(), 'read')
+        with flask_app.test_request_context('/actors', method='PATCH'):
+            self.assertEqual(request_class(), 'write')
+        with flask_app.test_request_context('/actors/bulk', method='POST'):
+            g.request_class = 'bulk'
+            self.assertEqual(request_class(), 'bulk')
+
+
+# SQLITE TEST DATABASE
+
+'''
+SQLiteTestCase
+Sets the app's models up on a fresh SQLite database in a temporary
+directory for each test. replica_names adds replicas next to it, and
+push_context pushes an app context for the whole test.
+'''
+class SQLiteTestCase(unittest.TestCase):
+    database_name = 'test.db'
+    replica_names = ()
+    push_context = True
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.database_path = self.sqlite_path(self.database_name)
+        self.app = Flask(__name__)
+        setup_db(self.app, self.database_path, [self.sqlite_path(name) for name in self.replica_names])
+        self.context = self.app.app_context() if self.push_context else None
+        if self.context is not None:
+            self.context.push()
+
+    def tearDown(self):
+        app_db.session.remove()
+        if self.context is not None:
+            self.context.pop()
+        self.directory.cleanup()
+
+    def sqlite_path(self, name):
+        return 'sqlite:///' + os.path.join(self.directory.name, name)
+
+
+# READ REPLICA TESTING
+
+class ReplicaRoutingTestCase(SQLiteTestCase):
+    database_name = 'primary.db'
+    replica_names = ('replica.db',)
+    push_context = False
+
+    def setUp(self):
+        super().setUp()
+        self.primary_path = self.database_path
+        self.replica_path = self.sqlite_path('replica.db')
+        # Stands in for replication: the same tables, with a row only the replica has
+        replica = replica_router.engines[0]
+        app_db.metadata.create_all(replica)
+        with replica.begin() as connection:
+            connection.execute(Actors.__table__.insert(), {'name': 'Replica Only', 'age': 40, 'gender': 'Female'})
+
+    def tearDown(self):
+        super().tearDown()
+        replica_router.configure([])
+
+    def count_replica_rows(self):
+        return Actors.query.filter_by(name='Replica Only').count()
+
+    # Test that GET requests read from the replica
+    def test_get_reads_from_replica(self):
+        with self.app.test_request_context('/actors', method='GET'):
+            self.assertEqual(self.count_replica_rows(), 1)
+            app_db.session.remove()
+
+    # Test that every read of a request goes to the same replica
+    def test_request_sticks_to_one_replica(self):
+        empty_path = self.sqlite_path('empty.db')
+        replica_router.configure([self.replica_path, empty_path])
+        app_db.metadata.create_all(replica_router.engines[1])
+        with self.app.test_request_context('/actors', method='GET'):
+            counts = [self.count_replica_rows() for turn in range(4)]
+            app_db.session.remove()
+
+        self.assertEqual(len(set(counts)), 1)
+
+    # Test that other requests stay on the primary
+    def test_write_requests_use_primary(self):
+        with self.app.test_request_context('/actors', method='POST'):
+            self.assertEqual(self.count_replica_rows(), 0)
+            app_db.session.remove()
+
+    # Test that a request reads its own writes once it wrote something
+    def test_read_after_write_uses_primary(self):
+        with self.app.test_request_context('/actors', method='GET'):
+            app_db.session.add(Actors(name='Primary Only', age=30, gender='Male'))
+            app_db.session.flush()
+            self.assertEqual(Actors.query.filter_by(name='Primary Only').count(), 1)
+            self.assertEqual(self.count_replica_rows(), 0)
+            app_db.session.rollback()
+            app_db.session.remove()
+
+    # Test that replicas are used in turn and a failing one is left out
+    def test_round_robin_and_ejection(self):
+        router = ReplicaRouter(clock=lambda: 0)
+        router.configure([self.replica_path, self.primary_path,
+            self.sqlite_path(os.path.join('missing', 'replica.db'))])
+        first, second, missing = router.engines
+
+        self.assertEqual([router.pick() for turn in range(3)], [first, second, missing])
+        router.check()
+        picks = [router.pick() for turn in range(4)]
+        self.assertEqual((picks.count(first), picks.count(second)), (2, 2))
+        self.assertNotIn(missing, picks)
+        self.assertEqual(router.stats(), {'replicas': 3, 'healthy': 2, 'ejections': 1})
+        router.configure([])
+
+
+# TABLE VERSION TESTING
+
+class TableVersionsTestCase(SQLiteTestCase):
+
+    def tearDown(self):
+        stale_tables.clear()
+        super().tearDown()
+
+    # Test that a write bumps its table's counter once committed
+    def test_commit_bumps_version(self):
+        app_db.session.add(Actors(name='Dwayne Johnson', age=49, gender='Male'))
+        bump_table_version('actors')
+        app_db.session.commit()
+
+        self.assertEqual(get_table_version('actors'), 1)
+        self.assertEqual(get_table_version('movies'), 0)
+
+    # Test that a counter that could not be bumped fails reads until a retry goes through
+    def test_failed_bump_fails_reads_until_retried(self):
+        engine = mock.Mock(dialect=app_db.engine.dialect)
+        engine.begin.side_effect = exc.OperationalError('UPDATE table_versions', {}, Exception('database is down'))
+        app_db.session.add(Actors(name='Dwayne Johnson', age=49, gender='Male'))
+        bump_table_version('actors')
+        with mock.patch.object(type(app_db), 'engine', new_callable=mock.PropertyMock, return_value=engine), \
+                mock.patch('models.TABLE_VERSION_BUMP_ATTEMPTS', 2):
+            app_db.session.commit()
+            with self.assertRaises(RuntimeError):
+                get_table_version('actors')
+
+        self.assertEqual(engine.begin.call_count, 4)
+        self.assertIn('actors', stale_tables)
+        self.assertEqual(get_table_version('actors'), 1)
+        self.assertNotIn('actors', stale_tables)
+
+
+# GROUP COMMIT TESTING
+
+class GroupCommitTestCase(SQLiteTestCase):
+    # Every submitting thread pushes its own app context
+    push_context = False
+
+    def write_actors(self, rows):
+        if any(row['name'] == 'Bad Actor' for row in rows):
+            raise ValueError('bad actor')
+        actors = [Actors(**row) for row in rows]
+        app_db.session.add_all(actors)
+        app_db.session.flush()
+        return [actor.format() for actor in actors]
+
+    # Submits every row from its own thread, returns each one's result or error
+    def submit_concurrently(self, committer, rows):
+        outcomes = [None] * len(rows)
+
+        def submit(index):
+            with self.app.app_context():
+                try:
+                    outcomes[index] = committer.submit(rows[index])
+                except Exception as error:
+                    outcomes[index] = error
+                finally:
+                    app_db.session.remove()
+
+        threads = [threading.Thread(target=submit, args=(index,)) for index in range(len(rows))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return outcomes
+
+    # Test that concurrent creates share one commit and still get their own ids
+    def test_concurrent_creates_share_a_commit(self):
+        committer = GroupCommitter(self.write_actors, window_ms=1000, max_rows=8)
+        rows = [{'name': 'Actor {}'.format(index), 'age': 30, 'gender': 'Male'} for index in range(8)]
+        outcomes = self.submit_concurrently(committer, rows)
+
+        self.assertEqual(committer.commits, 1)
+        self.assertEqual(sorted(outcome['name'] for outcome in outcomes), sorted(row['name'] for row in rows))
+        self.assertEqual(len({outcome['id'] for outcome in outcomes}), 8)
+
+    # Test that a bad row only fails its own caller
+    def test_bad_row_fails_only_its_caller(self):
+        committer = GroupCommitter(self.write_actors, window_ms=1000, max_rows=4)
+        rows = [{'name': name, 'age': 30, 'gender': 'Female'} for name in ('First', 'Bad Actor', 'Third', 'Fourth')]
+        outcomes = self.submit_concurrently(committer, rows)
+
+        self.assertIsInstance(outcomes[1], ValueError)
+        self.assertEqual([outcome['name'] for index, outcome in enumerate(outcomes) if index != 1],
+            ['First', 'Third', 'Fourth'])
+        with self.app.app_context():
+            self.assertEqual(Actors.query.count(), 3)
+
+
+# DATA EXPORT AND IMPORT TESTING
+
+class DataTransferTestCase(SQLiteTestCase):
+
+    # Test that an NDJSON import reports progress per batch and exports back as CSV
+    def test_import_then_export(self):
+        source = io.StringIO(''.join(json.dumps({'title': 'Movie {}'.format(number), 'release_date': 'May 29th, 2015'}) + '\n'
+            for number in range(5)))
+        reports = []
+        imported = import_table('movies', 'ndjson', source, batch_size=2, progress=lambda count, position: reports.append(count))
+        output = io.StringIO()
+        exported = export_table('movies', 'csv', output)
+
+        self.assertEqual(imported, 5)
+        self.assertEqual(reports, [2, 4, 5])
+        self.assertEqual(exported, 5)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[0], 'id,title,release_date')
+        self.assertEqual(lines[1], '1,Movie 0,2015-05-29')
+
+    # Test that an import resumed at an offset skips the records already added
+    def test_import_resumes_from_offset(self):
+        source = io.StringIO('name,age,gender\n' + ''.join('Actor {},{},Female\n'.format(number, 20 + number)
+            for number in range(6)))
+        imported = import_table('actors', 'csv', source, offset=4)
+
+        self.assertEqual(imported, 2)
+        self.assertEqual(sorted(actor.name for actor in Actors.query.all()), ['Actor 4', 'Actor 5'])
+
+    # Test that an invalid record stops the import with the offset to resume from
+    def test_import_reports_invalid_record(self):
+        source = io.StringIO('{"name": "First", "age": 30}\n{"name": "Second", "age": "x"}\n{"name": "Third"}\n')
+        with self.assertRaises(ImportRecordError) as raised:
+            import_table('actors', 'ndjson', source)
+
+        self.assertEqual(raised.exception.offset, 1)
+        self.assertEqual(raised.exception.errors, ['age must be an integer'])
+        self.assertEqual([actor.name for actor in Actors.query.all()], ['First'])
+
+    # Test that the postgres export passes bytes from COPY on as text
+    def test_copy_out_decodes_bytes(self):
+        def copy_expert(statement, file):
+            file.write(b'id,name,age,gender\n1,Ana,30,Female\n')
+        connection = mock.Mock()
+        connection.cursor.return_value.copy_expert.side_effect = copy_expert
+        output = io.StringIO()
+        with mock.patch('data_transfer.db') as fake_db:
+            fake_db.engine.raw_connection.return_value = connection
+            exported = copy_out(Actors, ('id', 'name', 'age', 'gender'), 'csv', output)
+
+        self.assertEqual(exported, 1)
+        self.assertEqual(output.getvalue(), 'id,name,age,gender\n1,Ana,30,Female\n')
+
+
+# DELTA SYNC TESTING
+
+class ChangesTestCase(SQLiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        app_db.session.add_all([Actors(name='Actor {}'.format(number), age=30, gender='Female') for number in range(3)])
+        bump_table_version('actors')
+        app_db.session.commit()
+
+    def delete_actor(self, record_id):
+        Actors.query.filter_by(id=record_id).delete()
+        record_tombstones('actors', [record_id])
+        bump_table_version('actors')
+        app_db.session.commit()
+
+    # Test that a first sync pages through every row, then only edits and deletes come back
+    def test_sync_pages_then_sends_only_changes(self):
+        first, since, has_more = changes_since(Actors, None, limit=2)
+        rest, since, more_after = changes_since(Actors, decode_since(since), limit=2)
+
+        self.assertEqual([record_id for record_id, actor in first + rest], [1, 2, 3])
+        self.assertTrue(has_more)
+        self.assertFalse(more_after)
+
+        Actors.query.get(2).age = 31
+        bump_table_version('actors')
+        app_db.session.commit()
+        self.delete_actor(3)
+        changes, next_since, has_more = changes_since(Actors, decode_since(since))
+
+        self.assertEqual([(record_id, actor and actor.age) for record_id, actor in changes], [(2, 31), (3, None)])
+        self.assertFalse(has_more)
+        self.assertEqual(changes_since(Actors, decode_since(next_since)), ([], next_since, False))
+
+    # Test that a row written without bump_table_version waits for the next commit to its table
+    def test_unstamped_row_waits_for_next_commit(self):
+        _, since, _ = changes_since(Actors, None)
+        Actors.query.get(1).age = 40
+        app_db.session.commit()
+
+        self.assertEqual(changes_since(Actors, decode_since(since))[0], [])
+        self.delete_actor(2)
+        self.assertEqual([record_id for record_id, actor in changes_since(Actors, decode_since(since))[0]], [1, 2])
+
+    # Test that the tombstone of an id used again is left out for the row
+    def test_reused_id_sends_row_only(self):
+        _, since, _ = changes_since(Actors, None)
+        self.delete_actor(3)
+        app_db.session.add(Actors(name='Actor 3 again', age=30, gender='Female'))
+        bump_table_version('actors')
+        app_db.session.commit()
+        changes, _, _ = changes_since(Actors, decode_since(since))
+
+        self.assertEqual([(record_id, actor.name) for record_id, actor in changes], [(3, 'Actor 3 again')])
+
+
+# ASYNC SERVING TESTING
+
+class AsyncServingTestCase(unittest.TestCase):
+
+    # Test that the async gunicorn settings run gevent workers
+    def test_async_settings(self):
+        settings = runpy.run_path(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gunicorn_async.py'))
+
+        self.assertEqual(settings['worker_class'], 'gevent')
+        self.assertGreater(settings['worker_connections'], 0)
+        self.assertTrue(callable(settings['post_worker_init']))
+
+    # Test that the app answers through gunicorn's gevent workers, with the
+    # signing keys fetched over a socket from a JWKS server
+    @unittest.skipIf(importlib.util.find_spec('gevent') is None or importlib.util.find_spec('gunicorn') is None,
+        'gevent and gunicorn are not installed')
+    def test_serves_requests_on_gevent_workers(self):
+        key = LocalSigningKey(bits=1024)
+        jwks = json.dumps(key.jwks()).encode()
+        fetches = []
+
+        class JWKSHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                fetches.append(self.path)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                self.wfile.write(jwks)
+
+            def log_message(self, *args):
+                pass
+
+        jwks_server = HTTPServer(('127.0.0.1', 0), JWKSHandler)
+        threading.Thread(target=jwks_server.serve_forever, daemon=True).start()
+        self.addCleanup(jwks_server.server_close)
+        self.addCleanup(jwks_server.shutdown)
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        env = dict(os.environ,
+            DATABASE_URL='sqlite:///' + os.path.join(directory.name, 'async.db'),
+            JWKS_URL='http://127.0.0.1:{}/.well-known/jwks.json'.format(jwks_server.server_port),
+            AUTH0_DOMAIN='async.local', API_AUDIENCE='async', ALGORITHMS='RS256',
+            BIND='127.0.0.1:{}'.format(port), WEB_CONCURRENCY='1', DATABASE_REPLICA_URLS='')
+        server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn_async.py', 'app:app'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.addCleanup(server.wait)
+        self.addCleanup(server.terminate)
+
+        base = 'http://127.0.0.1:{}'.format(port)
+        token = key.mint('async.local', 'async', ['create:actors', 'read:actors'])
+
+        def call(method, path, body=None):
+            request = urllib.request.Request(base + path, method=method,
+                data=json.dumps(body).encode() if body is not None else None,
+                headers={'Authorization': 'Bearer ' + token, 'Content-Type': 'application/json'})
+            with urllib.request.urlopen(request, timeout=10) as response:
+                return response.status, json.loads(response.read())
+
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                with urllib.request.urlopen(base + '/', timeout=1):
+                    break
+            except OSError:
+                if server.poll() is not None or time.monotonic() > deadline:
+                    self.fail('gunicorn did not start')
+                time.sleep(0.2)
+
+        created = call('POST', '/actors', {'name': 'Dwayne Johnson', 'age': 49, 'gender': 'Male'})
+        listed = call('GET', '/actors')
+        single = call('GET', '/actors/{}'.format(created[1]['actor']['id']))
+
+        self.assertEqual(created[0], 200)
+        self.assertEqual([actor['name'] for actor in listed[1]['actors']], ['Dwayne Johnson'])
+        self.assertEqual(single[1]['actor']['age'], 49)
+        self.assertEqual(fetches, ['/.well-known/jwks.json'])
+
+
+# BENCHMARK TESTING
+
+class BenchmarkTestCase(unittest.TestCase):
+
+    # Test that a locally minted token checks out against the local JWKS
+    def test_local_token_verifies(self):
+        signing_key = LocalSigningKey('bench-key', bits=1024)
+        token = signing_key.mint('bench.local', 'bench-api', ['read:actors'])
+        key = signing_key.jwks()['keys'][0]
+
+        self.assertEqual(jwt.get_unverified_header(token)['kid'], 'bench-key')
+        payload = jwt.decode(token, key, algorithms=['RS256'], audience='bench-api',
+            issuer='https://bench.local/')
+        self.assertEqual(payload['permissions'], ['read:actors'])
+
+    # Test that percentiles pick the nearest ranked sample
+    def test_percentile(self):
+        samples = [float(value) for value in range(1, 101)]
+
+        self.assertEqual(percentile(samples, 0.50), 50.0)
+        self.assertEqual(percentile(samples, 0.99), 99.0)
+        self.assertEqual(percentile([], 0.95), 0.0)
+
+    # Test that only regressions beyond the allowed percentage are reported
+    def test_baseline_regression(self):
+        baseline = {'routes': {'list_actors': {'p95_ms': 10.0, 'throughput_rps': 100.0}}}
+        slightly_worse = {'routes': {'list_actors': {'p95_ms': 11.0, 'throughput_rps': 95.0}}}
+        much_worse = {'routes': {'list_actors': {'p95_ms': 15.0, 'throughput_rps': 50.0}}}
+
+        self.assertEqual(compare(slightly_worse, baseline, 20), [])
+        self.assertEqual(len(compare(much_worse, baseline, 20)), 2)
 
 
 # Make the tests conveniently executable